@@ -86,9 +86,18 @@ Changes in 0.7.1
 # TODO: color stderr
 # TODO: simplify javascript using ,ore than 1 class in the class attribute?
 
+import cPickle as pickle
+import cProfile
 import datetime
+import glob
+import heapq
+import json
+import os
+import pstats
+import re
 import StringIO
 import sys
+import tempfile
 import time
 import unittest
 from xml.sax import saxutils
@@ -123,6 +132,63 @@ stdout_redirector = OutputRedirector(sys.stdout)
 stderr_redirector = OutputRedirector(sys.stderr)
 
 
+# Bytes of the output of a test kept for the report
+OUTPUT_LIMIT = 64 * 1024
+
+class OutputBuffer(object):
+    """
+    Buffer for the output of a test which keeps at most limit bytes of it,
+    unicode strings are stored encoded in UTF-8.
+    The first half of limit is kept in memory, the rest of the output is
+    spilled to a temporary file from which only its tail is read back.
+    """
+    def __init__(self, limit=OUTPUT_LIMIT):
+        self.head = StringIO.StringIO()
+        self.head_limit = limit // 2
+        self.tail_limit = limit - self.head_limit
+        self.spill = None
+        self.size = 0
+
+    def write(self, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        self.size += len(s)
+        if self.spill is None:
+            room = self.head_limit - self.head.tell()
+            if len(s) <= room:
+                self.head.write(s)
+                return
+            self.head.write(s[:room])
+            s = s[room:]
+            self.spill = tempfile.TemporaryFile()
+        self.spill.write(s)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        value = self.head.getvalue()
+        if self.spill is None:
+            return value
+        spilled = self.spill.tell()
+        self.spill.seek(max(spilled - self.tail_limit, 0))
+        tail = self.spill.read()
+        self.spill.seek(0, 2)
+        if spilled > self.tail_limit:
+            value += ('\n[... %d bytes omitted, %d bytes in total ...]\n'
+                % (spilled - self.tail_limit, self.size))
+        return value + tail
+
+    def close(self):
+        self.head.close()
+        if self.spill is not None:
+            self.spill.close()
+
+
 
 # ----------------------------------------------------------------------
 # Template
@@ -179,7 +245,7 @@ class Template_mixin(object):
     # ------------------------------------------------------------------------
     # HTML Template
 
-    HTML_TMPL = r"""<?xml version="1.0" encoding="UTF-8"?>
+    HTML_START_TMPL = r"""<?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
 <html xmlns="http://www.w3.org/1999/xhtml">
 <head>
@@ -266,13 +332,20 @@ function showOutput(id, name) {
 --></script>
 
 %(heading)s
-%(report)s
+"""
+    # variables: (title, generator, stylesheet, heading)
+
+    # The report is streamed between HTML_START_TMPL and HTML_END_TMPL
+
+    HTML_END_TMPL = r"""
+%(slowest)s
+%(sections)s
 %(ending)s
 
 </body>
 </html>
 """
-    # variables: (title, generator, stylesheet, heading, report, ending)
+    # variables: (slowest, ending)
 
 
     # ------------------------------------------------------------------------
@@ -365,7 +438,7 @@ h1 {
     # Report
     #
 
-    REPORT_TMPL = """
+    REPORT_START_TMPL = """
 <p id='show_detail_line'>Show
 <a href='javascript:showCase(0)'>Summary</a>
 <a href='javascript:showCase(1)'>Failed</a>
@@ -379,6 +452,7 @@ h1 {
 <col align='right' />
 <col align='right' />
 <col align='right' />
+<col align='right' />
 </colgroup>
 <tr id='header_row'>
     <td>Test Group/Test case</td>
@@ -387,8 +461,11 @@ h1 {
     <td>Fail</td>
     <td>Error</td>
     <td>View</td>
+    <td>Time</td>
 </tr>
-%(test_list)s
+""" # class rows, see REPORT_CLASS_TMPL, are written here while tests run
+
+    REPORT_END_TMPL = """
 <tr id='total_row'>
     <td>Total</td>
     <td>%(count)s</td>
@@ -396,9 +473,13 @@ h1 {
     <td>%(fail)s</td>
     <td>%(error)s</td>
     <td>&nbsp;</td>
+    <td>%(time)s</td>
 </tr>
 </table>
-""" # variables: (test_list, count, Pass, fail, error)
+<div class='heading'>
+%(parameters)s
+</div>
+""" # variables: (count, Pass, fail, error, time, parameters)
 
     REPORT_CLASS_TMPL = r"""
 <tr class='%(style)s'>
@@ -408,24 +489,27 @@ h1 {
     <td id="total_fail">%(fail)s</td>
     <td id="total_error">%(error)s</td>
     <td><a href="javascript:showClassDetail('%(cid)s',%(count)s)">Detail</a></td>
+    <td>%(time)s</td>
 </tr>
-""" # variables: (style, desc, count, Pass, fail, error, cid)
+""" # variables: (style, desc, count, Pass, fail, error, cid, time)
 
 
     REPORT_TEST_WITH_OUTPUT_TMPL = r"""
 <tr id='%(tid)s' class='%(Class)s'>
     <td class='%(style)s'><div class='testcase'>%(desc)s</div></td>
     <td colspan='5' align='center'><a href="javascript:showOutput('%(tid)s', '%(desc)s')">%(status)s</a>%(script)s</td>
+    <td>%(time)s</td>
 </tr>
-""" # variables: (tid, Class, style, desc, status)
+""" # variables: (tid, Class, style, desc, status, time)
 
 
     REPORT_TEST_NO_OUTPUT_TMPL = r"""
 <tr id='%(tid)s' class='%(Class)s'>
     <td class='%(style)s'><div class='testcase'>%(desc)s</div></td>
     <td colspan='5' align='center'>%(status)s</td>
+    <td>%(time)s</td>
 </tr>
-""" # variables: (tid, Class, style, desc, status)
+""" # variables: (tid, Class, style, desc, status, time)
 
 
     REPORT_TEST_OUTPUT_TMPL = r"""
@@ -433,6 +517,59 @@ h1 {
 """ # variables: (id, output)
 
 
+    SLOWEST_TMPL = """
+<h2>Top %(count)s slowest %(kind)s</h2>
+<table id='result_table'>
+<tr id='header_row'>
+    <td>%(column)s</td>
+    <td>Wall time</td>
+    <td>CPU time</td>
+</tr>
+%(rows)s
+</table>
+""" # variables: (count, kind, column, rows)
+
+
+    SLOWEST_ROW_TMPL = """<tr>
+    <td>%(desc)s</td>
+    <td>%(time)s</td>
+    <td>%(cpu_time)s</td>
+</tr>
+""" # variables: (desc, time, cpu_time)
+
+
+    SECTION_TMPL = """
+<h2>%(title)s</h2>
+<table id='result_table'>
+<tr id='header_row'>%(header)s</tr>
+%(rows)s
+</table>
+""" # variables: (title, header, rows)
+
+
+    PROFILE_TMPL = """
+<h2>Profiles</h2>
+<table id='result_table'>
+<tr id='header_row'>
+    <td>Profile</td>
+    <td>Time</td>
+    <td>Stats</td>
+    <td>Collapsed stacks</td>
+</tr>
+%(rows)s
+</table>
+""" # variables: (rows)
+
+
+    PROFILE_ROW_TMPL = """<tr>
+    <td>%(name)s</td>
+    <td>%(time)s</td>
+    <td><a href="%(stats)s">pstats</a></td>
+    <td><a href="%(collapsed)s">collapsed</a></td>
+</tr>
+""" # variables: (name, time, stats, collapsed)
+
+
 
     # ------------------------------------------------------------------------
     # ENDING
@@ -440,6 +577,29 @@ h1 {
 
     ENDING_TMPL = """<div id='ending'>&nbsp;</div>"""
 
+
+
+    # ------------------------------------------------------------------------
+    # JUnit XML
+    #
+
+    JUNIT_START_TMPL = """<?xml version="1.0" encoding="UTF-8"?>
+<testsuites name="%(title)s">
+""" # variables: (title)
+
+    JUNIT_SUITE_TMPL = """<testsuite name="%(name)s" tests="%(count)s" failures="%(fail)s" errors="%(error)s" time="%(time).3f">
+%(cases)s</testsuite>
+""" # variables: (name, count, fail, error, time, cases)
+
+    JUNIT_CASE_TMPL = """<testcase classname="%(classname)s" name="%(name)s" time="%(time).3f">%(problem)s</testcase>
+""" # variables: (classname, name, time, problem)
+
+    JUNIT_PROBLEM_TMPL = """<%(tag)s>%(trace)s</%(tag)s><system-out>%(output)s</system-out>"""
+    # variables: (tag, trace, output)
+
+    JUNIT_END_TMPL = """</testsuites>
+"""
+
 # -------------------- The end of the Template class -------------------
 
 
@@ -458,26 +618,130 @@ def jsEscapeString(s):
     # Note: previously we encode < as &lt;, etc. However IE6 fail to treat <script> block as CDATA.
 
 
+class TestInfo(object):
+    """
+    Picklable snapshot of a TestCase holding what the report needs from it,
+    so results can be merged from tests run in another process.
+    """
+    def __init__(self, test, group=None):
+        cls = test.__class__
+        # group is a function returning the name of the group of a test,
+        # tests are grouped by the module of their class by default
+        self.group = group and group(test) or cls.__module__
+        self.class_module = cls.__module__
+        self.class_name = cls.__name__
+        self.class_doc = cls.__doc__ and cls.__doc__.split("\n")[0] or ""
+        self._id = test.id()
+        self._description = test.shortDescription()
+        # wall and CPU seconds spent between startTest and stopTest
+        self.time = 0.0
+        self.cpu_time = 0.0
+        # size of the whole output, the report only shows part of it
+        self.output_size = 0
+
+    def id(self):
+        return self._id
+
+    def shortDescription(self):
+        return self._description
+
+
+def formatTime(seconds):
+    return '%.2fs' % seconds
+
+
+# characters not allowed in XML 1.0
+_XML_INVALID = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+def profileName(name):
+    "Return name usable as the name of a profile file"
+    return re.sub(r'[^\w.-]', '_', name)
+
+
+def collapsedStacks(stats, minimum=0.0001, depth=64):
+    """
+    Return the 'frame;frame;... microseconds' lines of flame graph tools
+    estimated from the callers of each function of stats, as cProfile does
+    not keep whole stacks. The time of a function is split between the stacks
+    of its callers as it was called by each one. Stacks below minimum seconds
+    are dropped.
+    """
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.iteritems():
+        for caller, (_, _, _, caller_ct) in callers.iteritems():
+            callees.setdefault(caller, []).append((func, caller_ct))
+    totals = {}
+
+    def walk(func, seconds, stack, path):
+        cc, nc, tt, ct, callers = stats.stats[func]
+        filename, line, name = func
+        stack = stack + ['%s(%s:%d)' % (name, os.path.basename(filename),
+                line)]
+        scale = seconds / ct if ct else 0.0
+        key = ';'.join(stack).replace(' ', '_')
+        totals[key] = totals.get(key, 0.0) + tt * scale
+        if len(stack) >= depth:
+            return
+        path = path | set([func])
+        for callee, callee_ct in callees.get(func, ()):
+            if callee not in path and callee_ct * scale >= minimum:
+                walk(callee, callee_ct * scale, stack, path)
+
+    for func, (cc, nc, tt, ct, callers) in stats.stats.iteritems():
+        if not callers:
+            walk(func, ct, [], set())
+    return ['%s %d' % (key, seconds * 1000000)
+        for key, seconds in sorted(totals.iteritems())
+        if seconds >= minimum]
+
+
+def xmlEscapeString(s):
+    """ Escape s for use as XML text or attribute """
+    if isinstance(s, str):
+        s = s.decode('latin-1')
+    return saxutils.escape(_XML_INVALID.sub(u'?', s), {'"': '&quot;'})
+
+
 TestResult = unittest.TestResult
 
 class _TestResult(TestResult):
     # note: _TestResult is a pure representation of results.
     # It lacks the output and reporting ability compares to unittest._TextTestResult.
 
-    def __init__(self, verbosity=1, failfast=False):
+    def __init__(self, verbosity=1, failfast=False, listener=None,
+            output_limit=OUTPUT_LIMIT, group=None, on_start=None,
+            on_stop=None, profile_dir=None):
         TestResult.__init__(self)
+        self.group = group
+        # on_start(test) is called before each test runs and on_stop(test)
+        # once it is finished
+        self.on_start = on_start
+        self.on_stop = on_stop
+        # each test is profiled if there is a profile_dir, where the stats
+        # of the tests of each class and group are written by dumpProfiles()
+        self.profile_dir = profile_dir
+        self.profiler = None
+        self.profiles = {}
         self.stdout0 = None
         self.stderr0 = None
+        self.outputBuffer = None
+        self.output_limit = output_limit
         self.success_count = 0
         self.failure_count = 0
         self.error_count = 0
         self.verbosity = verbosity
         self.failfast = failfast
+        self.test = None
+        self.info = None
+        self.pending = None
+        # listener.addResult(result, record) is called with each record
+        # when its test finishes. They are kept in result if there is none.
+        self.listener = listener
 
         # result is a list of result in 4 tuple
         # (
         #   result code (0: success; 1: fail; 2: error),
-        #   TestCase object,
+        #   TestInfo object,
         #   Test output (byte string),
         #   stack trace,
         # )
@@ -486,14 +750,23 @@ class _TestResult(TestResult):
 
     def startTest(self, test):
         TestResult.startTest(self, test)
+        self.test = test
+        self.info = TestInfo(test, self.group)
+        if self.on_start:
+            self.on_start(test)
+        self.startTime = time.time()
+        self.startClock = time.clock()
         # just one buffer for both stdout and stderr
-        self.outputBuffer = StringIO.StringIO()
+        self.outputBuffer = OutputBuffer(self.output_limit)
         stdout_redirector.fp = self.outputBuffer
         stderr_redirector.fp = self.outputBuffer
         self.stdout0 = sys.stdout
         self.stderr0 = sys.stderr
         sys.stdout = stdout_redirector
         sys.stderr = stderr_redirector
+        if self.profile_dir:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
 
 
     def complete_output(self):
@@ -506,6 +779,8 @@ class _TestResult(TestResult):
             sys.stderr = self.stderr0
             self.stdout0 = None
             self.stderr0 = None
+        if self.outputBuffer is None:
+            return ''
         return self.outputBuffer.getvalue()
 
 
@@ -513,14 +788,69 @@ class _TestResult(TestResult):
         # Usually one of addSuccess, addError or addFailure would have been called.
         # But there are some path in unittest that would bypass this.
         # We must disconnect stdout in stopTest(), which is guaranteed to be called.
+        if self.profiler:
+            self.profiler.disable()
         self.complete_output()
+        if test is self.test:
+            self.info.time = time.time() - self.startTime
+            self.info.cpu_time = time.clock() - self.startClock
+            if self.profiler:
+                self.addProfile(self.info, self.profiler)
+                self.profiler = None
+            self.info.output_size = self.outputBuffer.size
+            self.outputBuffer.close()
+            self.outputBuffer = None
+            self.test = None
+        if self.pending:
+            self.addRecord(self.pending)
+            self.pending = None
+        if self.on_stop:
+            self.on_stop(test)
+
+
+    def addProfile(self, info, profiler):
+        for name in ('class-%s.%s' % (info.class_module, info.class_name),
+                'group-%s' % info.group):
+            if name in self.profiles:
+                self.profiles[name].add(profiler)
+            else:
+                self.profiles[name] = pstats.Stats(profiler)
+
+
+    def dumpProfiles(self):
+        """
+        Write the stats of the tests run to profile_dir, a file for each
+        class and group named after the process so several of them can write
+        to the same directory. They are merged by mergeProfiles().
+        """
+        for name, stats in self.profiles.iteritems():
+            stats.dump_stats(os.path.join(self.profile_dir, '%s.%d.prof'
+                    % (profileName(name), os.getpid())))
+        self.profiles = {}
+
+
+    def finishTest(self, test, record):
+        # the record of the running test is added once timed by stopTest,
+        # errors of setUpClass and alike are added without startTest
+        if test is self.test:
+            self.pending = record
+        else:
+            self.addRecord(record)
+
+
+    def addRecord(self, record):
+        "Add the (code, TestInfo, output, stack trace) record of a test"
+        if self.listener is None:
+            self.result.append(record)
+        else:
+            self.listener.addResult(self, record)
 
 
     def addSuccess(self, test):
         self.success_count += 1
         TestResult.addSuccess(self, test)
         output = self.complete_output()
-        self.result.append((0, test, output, ''))
+        self.finishTest(test, (0, self.getInfo(test), output, ''))
         if self.verbosity > 1:
             sys.stderr.write('ok ')
             sys.stderr.write(str(test))
@@ -533,7 +863,7 @@ class _TestResult(TestResult):
         TestResult.addError(self, test, err)
         _, _exc_str = self.errors[-1]
         output = self.complete_output()
-        self.result.append((2, test, output, _exc_str))
+        self.finishTest(test, (2, self.getInfo(test), output, _exc_str))
         if self.verbosity > 1:
             sys.stderr.write('E  ')
             sys.stderr.write(str(test))
@@ -548,7 +878,7 @@ class _TestResult(TestResult):
         TestResult.addFailure(self, test, err)
         _, _exc_str = self.failures[-1]
         output = self.complete_output()
-        self.result.append((1, test, output, _exc_str))
+        self.finishTest(test, (1, self.getInfo(test), output, _exc_str))
         if self.verbosity > 1:
             sys.stderr.write('F  ')
             sys.stderr.write(str(test))
@@ -558,15 +888,66 @@ class _TestResult(TestResult):
         if self.failfast:
             self.stop()
 
+    def getInfo(self, test):
+        if test is self.test:
+            return self.info
+        return TestInfo(test, self.group)
+
+    def load(self, fp):
+        """
+        Add the records stored by a ResultDumper into this result. A
+        truncated file, from a crashed process, is read up to its last
+        complete record.
+        """
+        while True:
+            try:
+                record = pickle.load(fp)
+            except (EOFError, pickle.UnpicklingError):
+                break
+            self.testsRun += 1
+            if record[0] == 0:
+                self.success_count += 1
+            elif record[0] == 1:
+                self.failure_count += 1
+            else:
+                self.error_count += 1
+            self.addRecord(record)
+
+
+class ResultDumper(object):
+    """
+    Listener of _TestResult which pickles each record to fp as soon as its
+    test finishes, so another process can load() them.
+    """
+    def __init__(self, fp):
+        self.fp = fp
+
+    def addResult(self, result, record):
+        pickle.dump(record, self.fp, pickle.HIGHEST_PROTOCOL)
+        self.fp.flush()
+
 
 class HTMLTestRunner(Template_mixin):
     """
     """
     def __init__(self, stream=sys.stdout, verbosity=1, title=None,
-            description=None, failfast=False):
+            description=None, failfast=False, slowest=10,
+            output_limit=OUTPUT_LIMIT, json_stream=None, junit_stream=None,
+            group=None, on_start=None, on_stop=None, profile_dir=None):
         self.stream = stream
+        self.group = group
+        self.on_start = on_start
+        self.on_stop = on_stop
+        # profiles are linked from the report relative to its directory
+        self.profile_dir = profile_dir
+        # machine readable results written along the report, a JSON
+        # object per line for each test and the summary, and JUnit XML
+        self.json_stream = json_stream
+        self.junit_stream = junit_stream
         self.verbosity = verbosity
         self.failfast = failfast
+        self.slowest = slowest
+        self.output_limit = output_limit
         if title is None:
             self.title = self.DEFAULT_TITLE
         else:
@@ -577,31 +958,163 @@ class HTMLTestRunner(Template_mixin):
             self.description = description
 
         self.startTime = datetime.datetime.now()
+        # tables added to the end of the report by addSection()
+        self.sections = []
 
 
     def run(self, test):
-        "Run the given test case or test suite."
-        result = _TestResult(self.verbosity, failfast=self.failfast)
+        """
+        Run the given test case or test suite. The report is written while
+        the tests run, each class as soon as its tests are finished.
+        """
+        result = _TestResult(self.verbosity, failfast=self.failfast,
+            listener=self, output_limit=self.output_limit, group=self.group,
+            on_start=self.on_start, on_stop=self.on_stop,
+            profile_dir=self.profile_dir)
+        self.startReport()
         test(result)
+        if self.profile_dir:
+            result.dumpProfiles()
+        self.stopReport(result)
+        return result
+
+
+    def startReport(self):
+        "Write the report up to the table header"
+        self.classCount = 0
+        self.currentClass = None
+        self.classResults = []
+        self.classTimes = {}
+        # wall time spent on the tests of each group
+        self.groupTimes = {}
+        self.slowestTests = []
+        self.totalTime = 0.0
+        generator = 'HTMLTestRunner %s' % __version__
+        heading = self._generate_heading([
+                ('Start Time', str(self.startTime)[:19]),
+                ])
+        output = self.HTML_START_TMPL % dict(
+            title = saxutils.escape(self.title),
+            generator = generator,
+            stylesheet = self._generate_stylesheet(),
+            heading = heading,
+        )
+        self.stream.write(output.encode('utf8'))
+        self.stream.write(self.REPORT_START_TMPL.encode('utf8'))
+        self.stream.flush()
+        if self.junit_stream:
+            self.junit_stream.write(self.JUNIT_START_TMPL % dict(
+                    title = xmlEscapeString(self.title).encode('utf8'),
+                ))
+
+
+    def addResult(self, result, record):
+        """
+        Add the record of a finished test to the report. Consecutive tests
+        of the same class are written together once the class changes.
+        """
+        n,t,o,e = record
+        cls = (t.class_module, t.class_name, t.class_doc)
+        if cls != self.currentClass:
+            self._write_class()
+            self.currentClass = cls
+        self.classResults.append(record)
+
+        self.totalTime += t.time
+        times = self.classTimes.setdefault(cls[:2], [0.0, 0.0])
+        times[0] += t.time
+        times[1] += t.cpu_time
+        if t.group:
+            self.groupTimes[t.group] = (self.groupTimes.get(t.group, 0.0)
+                + t.time)
+        if self.slowest:
+            item = (t.time, t.cpu_time, t.id())
+            if len(self.slowestTests) < self.slowest:
+                heapq.heappush(self.slowestTests, item)
+            else:
+                heapq.heappushpop(self.slowestTests, item)
+        if self.json_stream:
+            self._write_json({
+                    'type': 'test',
+                    'id': t.id(),
+                    'class': '%s.%s' % cls[:2],
+                    'module': t.group,
+                    'status': self.STATUS[n],
+                    'time': t.time,
+                    'cpu_time': t.cpu_time,
+                    'output_size': t.output_size,
+                    })
+
+
+    def addSection(self, title, columns, rows):
+        "Add a table with the columns and rows of strings to the report"
+        self.sections.append((title, columns, rows))
+
+
+    def stopReport(self, result):
+        "Write the totals and the end of the report"
+        self._write_class()
         self.stopTime = datetime.datetime.now()
-        self.generateReport(test, result)
+        a_lines = []
+        for name, value in self.getReportAttributes(result):
+            a_lines.append(self.HEADING_ATTRIBUTE_TMPL % dict(
+                    name = saxutils.escape(name),
+                    value = saxutils.escape(value),
+                ))
+        output = self.REPORT_END_TMPL % dict(
+            count = str(result.success_count+result.failure_count+result.error_count),
+            Pass = str(result.success_count),
+            fail = str(result.failure_count),
+            error = str(result.error_count),
+            time = formatTime(self.totalTime),
+            parameters = ''.join(a_lines),
+        )
+        output += self.HTML_END_TMPL % dict(
+            slowest = self._generate_slowest(),
+            sections = self._generate_sections() + self._generate_profiles(),
+            ending = self._generate_ending(),
+        )
+        self.stream.write(output.encode('utf8'))
+        self.stream.flush()
+        if self.junit_stream:
+            self.junit_stream.write(self.JUNIT_END_TMPL)
+            self.junit_stream.flush()
+        if self.json_stream:
+            self._write_json({
+                    'type': 'summary',
+                    'title': self.title,
+                    'start': str(self.startTime)[:19],
+                    'duration': (self.stopTime
+                        - self.startTime).total_seconds(),
+                    'count': (result.success_count + result.failure_count
+                        + result.error_count),
+                    'pass': result.success_count,
+                    'fail': result.failure_count,
+                    'error': result.error_count,
+                    'time': self.totalTime,
+                    })
         print >>sys.stderr, '\nTime Elapsed: %s' % (self.stopTime-self.startTime)
-        return result
 
 
-    def sortResult(self, result_list):
-        # unittest does not seems to run in any particular order.
-        # Here at least we want to group them together by class.
-        rmap = {}
-        classes = []
-        for n,t,o,e in result_list:
-            cls = t.__class__
-            if not rmap.has_key(cls):
-                rmap[cls] = []
-                classes.append(cls)
-            rmap[cls].append((n,t,o,e))
-        r = [(cls, rmap[cls]) for cls in classes]
-        return r
+    def _write_json(self, data):
+        self.json_stream.write(json.dumps(data) + '\n')
+        self.json_stream.flush()
+
+
+    def _write_class(self):
+        if not self.classResults:
+            return
+        rows = []
+        self._generate_class(rows, self.classCount, self.currentClass,
+            self.classResults)
+        self.stream.write(''.join(rows).encode('utf8'))
+        self.stream.flush()
+        if self.junit_stream:
+            self.junit_stream.write(self._generate_junit(self.currentClass,
+                    self.classResults).encode('utf8'))
+            self.junit_stream.flush()
+        self.classCount += 1
+        self.classResults = []
 
 
     def getReportAttributes(self, result):
@@ -626,24 +1139,6 @@ class HTMLTestRunner(Template_mixin):
         ]
 
 
-    def generateReport(self, test, result):
-        report_attrs = self.getReportAttributes(result)
-        generator = 'HTMLTestRunner %s' % __version__
-        stylesheet = self._generate_stylesheet()
-        heading = self._generate_heading(report_attrs)
-        report = self._generate_report(result)
-        ending = self._generate_ending()
-        output = self.HTML_TMPL % dict(
-            title = saxutils.escape(self.title),
-            generator = generator,
-            stylesheet = stylesheet,
-            heading = heading,
-            report = report,
-            ending = ending,
-        )
-        self.stream.write(output.encode('utf8'))
-
-
     def _generate_stylesheet(self):
         return self.STYLESHEET_TMPL
 
@@ -664,47 +1159,142 @@ class HTMLTestRunner(Template_mixin):
         return heading
 
 
-    def _generate_report(self, result):
-        rows = []
-        sortedResult = self.sortResult(result.result)
-        for cid, (cls, cls_results) in enumerate(sortedResult):
-            # subtotal for a class
-            np = nf = ne = 0
-            for n,t,o,e in cls_results:
-                if n == 0: np += 1
-                elif n == 1: nf += 1
-                else: ne += 1
-
-            # format class description
-            if cls.__module__ == "__main__":
-                name = cls.__name__
-            else:
-                name = "%s.%s" % (cls.__module__, cls.__name__)
-            doc = cls.__doc__ and cls.__doc__.split("\n")[0] or ""
-            desc = doc and '%s: %s' % (name, doc) or name
-
-            row = self.REPORT_CLASS_TMPL % dict(
-                style = ne > 0 and 'errorClass' or nf > 0 and 'failClass' or 'passClass',
-                desc = desc,
-                count = np+nf+ne,
-                Pass = np,
-                fail = nf,
-                error = ne,
-                cid = 'c%s' % (cid+1),
-            )
-            rows.append(row)
-
-            for tid, (n,t,o,e) in enumerate(cls_results):
-                self._generate_report_test(rows, cid, tid, n, t, o, e)
-
-        report = self.REPORT_TMPL % dict(
-            test_list = ''.join(rows),
-            count = str(result.success_count+result.failure_count+result.error_count),
-            Pass = str(result.success_count),
-            fail = str(result.failure_count),
-            error = str(result.error_count),
+    def _generate_class(self, rows, cid, cls, cls_results):
+        # subtotal for a class
+        np = nf = ne = 0
+        for n,t,o,e in cls_results:
+            if n == 0: np += 1
+            elif n == 1: nf += 1
+            else: ne += 1
+        duration = sum(t.time for n,t,o,e in cls_results)
+
+        # format class description
+        module, name, doc = cls
+        if module != "__main__":
+            name = "%s.%s" % (module, name)
+        desc = doc and '%s: %s' % (name, doc) or name
+
+        row = self.REPORT_CLASS_TMPL % dict(
+            style = ne > 0 and 'errorClass' or nf > 0 and 'failClass' or 'passClass',
+            desc = desc,
+            count = np+nf+ne,
+            Pass = np,
+            fail = nf,
+            error = ne,
+            cid = 'c%s' % (cid+1),
+            time = formatTime(duration),
+        )
+        rows.append(row)
+
+        for tid, (n,t,o,e) in enumerate(cls_results):
+            self._generate_report_test(rows, cid, tid, n, t, o, e)
+
+
+    def _generate_junit(self, cls, cls_results):
+        classname = xmlEscapeString('%s.%s' % cls[:2])
+        cases = []
+        for n,t,o,e in cls_results:
+            problem = ''
+            if n:
+                problem = self.JUNIT_PROBLEM_TMPL % dict(
+                    tag = n == 1 and 'failure' or 'error',
+                    trace = xmlEscapeString(e),
+                    output = xmlEscapeString(o),
+                )
+            cases.append(self.JUNIT_CASE_TMPL % dict(
+                classname = classname,
+                name = xmlEscapeString(t.id().split('.')[-1]),
+                time = t.time,
+                problem = problem,
+            ))
+        return self.JUNIT_SUITE_TMPL % dict(
+            name = classname,
+            count = len(cls_results),
+            fail = len([r for r in cls_results if r[0] == 1]),
+            error = len([r for r in cls_results if r[0] == 2]),
+            time = sum(t.time for n,t,o,e in cls_results),
+            cases = ''.join(cases),
+        )
+
+
+    def _generate_slowest(self):
+        if not self.slowest:
+            return ''
+        classes = [(d, c, '%s.%s' % k)
+            for k, (d, c) in self.classTimes.iteritems()]
+        sections = []
+        for kind, column, items in (('tests', 'Test case', self.slowestTests),
+                ('classes', 'Test Group', classes)):
+            rows = [self.SLOWEST_ROW_TMPL % dict(
+                    desc = saxutils.escape(desc),
+                    time = formatTime(duration),
+                    cpu_time = formatTime(cpu_time),
+                ) for duration, cpu_time, desc in heapq.nlargest(
+                    self.slowest, items)]
+            sections.append(self.SLOWEST_TMPL % dict(
+                count = len(rows),
+                kind = kind,
+                column = column,
+                rows = ''.join(rows),
+            ))
+        return ''.join(sections)
+
+
+    def _generate_sections(self):
+        sections = []
+        for title, columns, rows in self.sections:
+            sections.append(self.SECTION_TMPL % dict(
+                title = saxutils.escape(title),
+                header = ''.join('<td>%s</td>' % saxutils.escape(c)
+                    for c in columns),
+                rows = ''.join('<tr>%s</tr>\n' % ''.join(
+                        '<td>%s</td>' % saxutils.escape(v) for v in row)
+                    for row in rows),
+            ))
+        return ''.join(sections)
+
+
+    def mergeProfiles(self):
+        """
+        Merge the stats written by dumpProfiles() of each class and group in
+        a pstats and a collapsed stacks file and return the (name, time) of
+        them, the slowest first.
+        """
+        files = {}
+        for filename in glob.glob(os.path.join(self.profile_dir, '*.prof')):
+            name = os.path.basename(filename).rsplit('.', 2)[0]
+            files.setdefault(name, []).append(filename)
+        profiles = []
+        for name, filenames in files.iteritems():
+            stats = pstats.Stats(*filenames)
+            path = os.path.join(self.profile_dir, name)
+            stats.dump_stats(path + '.pstats')
+            f = open(path + '.collapsed', 'w')
+            try:
+                f.writelines(l + '\n' for l in collapsedStacks(stats))
+            finally:
+                f.close()
+            for filename in filenames:
+                os.remove(filename)
+            profiles.append((stats.total_tt, name))
+        return [(name, total) for total, name in sorted(profiles,
+                reverse=True)]
+
+
+    def _generate_profiles(self):
+        if not self.profile_dir:
+            return ''
+        directory = os.path.basename(os.path.normpath(self.profile_dir))
+        rows = [self.PROFILE_ROW_TMPL % dict(
+                name = saxutils.escape(name),
+                time = formatTime(total),
+                stats = saxutils.escape('%s/%s.pstats' % (directory, name)),
+                collapsed = saxutils.escape('%s/%s.collapsed'
+                    % (directory, name)),
+            ) for name, total in self.mergeProfiles()]
+        return self.PROFILE_TMPL % dict(
+            rows = ''.join(rows),
         )
-        return report
 
 
     def _generate_report_test(self, rows, cid, tid, n, t, o, e):
@@ -742,6 +1332,7 @@ class HTMLTestRunner(Template_mixin):
             desc = desc,
             script = script,
             status = self.STATUS[n],
+            time = formatTime(t.time),
         )
         rows.append(row)
         if not has_output:
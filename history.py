@@ -0,0 +1,117 @@
+import json
+import sqlite3
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class History(object):
+    """
+    Durations of the tests and modules of every test run stored in SQLite,
+    to follow their trend and detect regressions between runs.
+    """
+
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename, timeout=60)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS run ('
+                'id INTEGER PRIMARY KEY, branch TEXT, backend TEXT, '
+                'revision TEXT, timestamp TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS duration ('
+                'run INTEGER, kind TEXT, name TEXT, status TEXT, '
+                'duration REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS '
+                'duration_run ON duration (run, kind)')
+
+    def close(self):
+        self.connection.close()
+
+    def add_run(self, branch, backend, revision, timestamp, results):
+        """
+        Store the durations of the tests, and of the modules as the sum of
+        their tests, read from the JSON lines results file of test.py.
+        Return the id of the new run.
+        """
+        rows = []
+        modules = {}
+        with open(results) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('type') != 'test':
+                    continue
+                rows.append(('test', record['id'], record['status'],
+                        record['time']))
+                module = record.get('module')
+                if module:
+                    modules[module] = modules.get(module, 0.0) + record['time']
+        rows.extend(('module', m, None, d) for m, d in modules.iteritems())
+        with self.connection:
+            cursor = self.connection.execute('INSERT INTO run '
+                '(branch, backend, revision, timestamp) VALUES (?, ?, ?, ?)',
+                (branch, backend, revision, timestamp))
+            run = cursor.lastrowid
+            self.connection.executemany('INSERT INTO duration '
+                '(run, kind, name, status, duration) VALUES (?, ?, ?, ?, ?)',
+                [(run,) + r for r in rows])
+        return run
+
+    def runs(self, branch, backend, before=None, limit=10):
+        """
+        Return the last (id, revision, timestamp) runs of branch and backend,
+        newest first, optionally only the ones before the run id before.
+        """
+        query = 'SELECT id, revision, timestamp FROM run ' \
+            'WHERE branch = ? AND backend = ?'
+        args = [branch, backend]
+        if before is not None:
+            query += ' AND id < ?'
+            args.append(before)
+        query += ' ORDER BY id DESC LIMIT ?'
+        args.append(limit)
+        return self.connection.execute(query, args).fetchall()
+
+    def durations(self, runs, kind):
+        "Return {name: {run: duration}} of kind ('test' or 'module') in runs"
+        result = {}
+        if not runs:
+            return result
+        cursor = self.connection.execute('SELECT name, run, duration '
+            'FROM duration WHERE kind = ? AND run IN (%s)'
+            % ','.join('?' * len(runs)), [kind] + list(runs))
+        for name, run, duration in cursor:
+            result.setdefault(name, {})[run] = duration
+        return result
+
+    def statuses(self, run):
+        "Return {name: status} of the tests of run"
+        return dict(self.connection.execute('SELECT name, status '
+                'FROM duration WHERE kind = ? AND run = ?', ('test', run)))
+
+    def regressions(self, run, branch, backend, ratio, window=10,
+            minimum=1.0):
+        """
+        Return the (name, duration, median) of the tests of run which took
+        more than ratio times their median duration on the previous window
+        runs. Tests faster than minimum seconds are ignored as noise.
+        """
+        previous = [r[0] for r in self.runs(branch, backend, before=run,
+                limit=window)]
+        history = self.durations(previous, 'test')
+        result = []
+        for name, durations in self.durations([run], 'test').iteritems():
+            duration = durations[run]
+            if duration < minimum or name not in history:
+                continue
+            average = median(history[name].values())
+            if duration > ratio * average:
+                result.append((name, duration, average))
+        result.sort(key=lambda r: r[1] / (r[2] or 1), reverse=True)
+        return result
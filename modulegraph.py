@@ -0,0 +1,70 @@
+import ConfigParser
+import os
+
+# The modules of trytond itself, whose tests are grouped as 'trytond'
+CORE_MODULES = ('ir', 'res')
+
+
+def module_roots(trytond_path):
+    """
+    Return a dictionary with the directory of every module found in
+    trytond_path, the ones with a tryton.cfg, and the name of the module.
+    """
+    roots = {}
+    for root, dirs, files in os.walk(trytond_path):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        if 'tryton.cfg' in files:
+            roots[os.path.normpath(root)] = os.path.basename(root)
+    return roots
+
+
+def get_module(roots, filename):
+    """
+    Return the (directory, name) of the module filename belongs to using the
+    roots index or (None, None) if it is not part of a module.
+    """
+    directory = os.path.dirname(os.path.normpath(filename))
+    while directory not in roots:
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None, None
+        directory = parent
+    return directory, roots[directory]
+
+
+def module_dependencies(roots):
+    "Return the graph of dependencies read from tryton.cfg of roots"
+    graph = {}
+    for directory, module in roots.iteritems():
+        config = ConfigParser.ConfigParser()
+        config.read(os.path.join(directory, 'tryton.cfg'))
+        depends = set()
+        if config.has_option('tryton', 'depends'):
+            depends.update(config.get('tryton', 'depends').split())
+        graph[module] = depends
+    return graph
+
+
+def dependents(graph, modules):
+    "Return modules and all the modules of graph depending on them"
+    reverse = {}
+    for module, depends in graph.iteritems():
+        for depend in depends:
+            reverse.setdefault(depend, set()).add(module)
+    result = set()
+    stack = list(modules)
+    while stack:
+        module = stack.pop()
+        if module in result:
+            continue
+        result.add(module)
+        stack.extend(reverse.get(module, ()))
+    return result
+
+
+def test_groups(modules):
+    "Return modules with 'trytond' added if one of the CORE_MODULES is in it"
+    modules = set(modules)
+    if modules.intersection(CORE_MODULES):
+        modules.add('trytond')
+    return modules
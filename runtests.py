@@ -1,21 +1,32 @@
 #!/usr/bin/python
 import ConfigParser
+import cgi
+import errno
 import getpass
 import glob
+import hashlib
+import json
 import logging
+import multiprocessing
 import optparse
 import os
 import re
 import shutil
 import subprocess
 import sys
+import tarfile
 import tempfile
 import time
 from datetime import datetime
+from email.mime.application import MIMEApplication
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from StringIO import StringIO
 import smtplib
+import sqlite3
+
+import modulegraph
+from history import History
 
 
 logging_filepath = "%s/logs/runtests.log" % os.getenv("HOME")
@@ -25,6 +36,15 @@ logging.basicConfig(filename=logging_filepath,
 logger = logging.getLogger('runtests')
 logger.info("Starting execution")
 
+# The lint pool is shared by the branches, one of them linting at a time,
+# and the default limits leave room for it and for two branches testing
+# both backends with one process each
+LINT_JOBS = max(multiprocessing.cpu_count() // 2, 1)
+MAX_PROCESSES = max(multiprocessing.cpu_count(), LINT_JOBS + 2 * 2)
+# PostgreSQL connections opened by a test process: its database, the one
+# it is created from and the nested transactions of the tests
+PROCESS_CONNECTIONS = 4
+
 parser = optparse.OptionParser()
 parser.add_option('-b', '--branch', dest='branch', help='specify branch')
 parser.add_option('-s', '--sqlite-only', action='store_true',
@@ -38,14 +58,66 @@ parser.add_option('-u', '--unittest-only', action='store_true',
     dest='unittest_only')
 parser.add_option('', '--failfast', action='store_true',
     dest='failfast')
+parser.add_option('-a', '--affected-only', action='store_true',
+    dest='affected_only', help='only test the modules changed since the '
+    'last successful run and the modules depending on them')
+parser.add_option('-i', '--impacted-only', action='store_true',
+    dest='impacted_only', help='only run the tests which covered the files '
+    'changed since the last successful run on a previous --coverage run')
+parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+    help='number of worker processes used by each test run, with trytond '
+    '2.8 to 3.2')
+parser.add_option('', '--max-processes', dest='max_processes', type='int',
+    default=MAX_PROCESSES,
+    help='test processes that may run at the same time on all branches')
+parser.add_option('', '--max-memory', dest='max_memory', type='int',
+    help='memory in MB available to test processes (default: total memory)')
+parser.add_option('', '--process-memory', dest='process_memory', type='int',
+    default=512, help='estimated memory in MB used by each test process')
+parser.add_option('', '--max-connections', dest='max_connections',
+    type='int', default=100,
+    help='PostgreSQL connections available to all branches')
+parser.add_option('', '--lint-jobs', dest='lint_jobs', type='int',
+    default=LINT_JOBS,
+    help='number of modules checked at the same time by runflakes')
+parser.add_option('', '--regression-ratio', dest='regression_ratio',
+    type='float', help='fail the run when a test takes more than this times '
+    'its median duration on the previous runs')
+parser.add_option('', '--history-window', dest='history_window', type='int',
+    default=10, help='number of previous runs shown in the trend report and '
+    'used to compute the median durations')
+parser.add_option('', '--mail-reports', action='store_true',
+    dest='mail_reports', help='attach the HTML reports to the mail as a '
+    'tar.gz file')
+parser.add_option('', '--mail-limit', dest='mail_limit', type='int',
+    default=5 * 1024 * 1024, help='maximum size in bytes of the reports '
+    'attached with --mail-reports')
 
 (options, _) = parser.parse_args()
 logger.debug("Options for args %s: %s" % (sys.argv, options))
 
+# Maximum size in bytes of the body of the mails
+BODY_LIMIT = 64 * 1024
+REPORTS_URL = 'http://tests.nan-tic.com/'
+
+# Database type of each test config, used in the name of its reports
+DB_TYPES = {
+    'sqlite': 'sqlite',
+    'postgres': 'postgresql',
+    }
+
 FLAKES_IGNORE_LIST = [
     "'suite' imported but unused",
     "used; unable to detect undefined names",
     ]
+FLAKES_IGNORE = re.compile('|'.join(re.escape(x) for x in FLAKES_IGNORE_LIST))
+FLAKE8_IGNORE = 'E120,E121,E123,E124,E126,E127,E128,W0232,R0903'
+# flake8 default format: path:row:col: code text
+LINT_LINE = re.compile(r'^(.*?):(\d+):(?:(\d+):)? ([A-Z]+\d+) (.*)$')
+LINT_FORMAT = {
+    'pyflakes': '%(file)s:%(line)d: %(message)s',
+    'flake8': '%(file)s:%(line)d:%(col)d: %(code)s %(message)s',
+    }
 
 STYLE = """
 <style type="text/css" media="screen">
@@ -123,6 +195,8 @@ def get_settings(parser):
 exec_path = os.getcwd()
 menu_path = os.path.split(__file__)[0]
 rc_path = '%s/.tryton-tests.cfg' % os.getenv('HOME')
+cache_path = '%s/.tryton-tests-cache' % os.getenv('HOME')
+mirrors_path = os.path.join(cache_path, 'mirrors')
 
 parser = ConfigParser.ConfigParser()
 parser.read(rc_path)
@@ -135,39 +209,84 @@ if options.list:
     sys.exit(0)
 
 
-def send_mail(subject, body, log_file=None, files_dir=None):
+def reports_archive(files_dir):
+    "Return the HTML reports of files_dir as a tar.gz file content"
+    data = StringIO()
+    archive = tarfile.open(fileobj=data, mode='w:gz')
+    try:
+        for filename in sorted(glob.glob('%s/*.html' % files_dir)):
+            archive.add(filename, os.path.basename(filename))
+    finally:
+        archive.close()
+    return data.getvalue()
+
 
-    msg = MIMEMultipart('alternative')
+def send_mail(subject, body, log_file=None, files_dir=None):
+    """
+    Send body, cut to BODY_LIMIT, with the reports of files_dir attached if
+    --mail-reports is given and they fit in --mail-limit.
+    """
+    msg = MIMEMultipart()
     me = "tests@nan-tic.com"
     to = "intern@nan-tic.com"
 
     msg['Subject'] = subject
     msg['From'] = me
     msg['To'] = to
-    msg.preamble = body
-
-    files = glob.glob("%s/*.html" % files_dir)
-    data = ""
-    for fl in sorted(files, reverse=True):
-        f = open(fl, 'r')
-        data += "<h1> %s </h1>" % fl
-        data += f.read()
-        f.close()
-    msg.attach(MIMEText(data, 'html'))
+
+    attachment = None
+    if files_dir and options.mail_reports:
+        attachment = reports_archive(files_dir)
+        if len(attachment) > options.mail_limit:
+            body += ('\nReports not attached, %d bytes compressed'
+                % len(attachment))
+            attachment = None
+    if len(body) > BODY_LIMIT:
+        body = body[:BODY_LIMIT] + '\n[... %d bytes omitted ...]\n' % (
+            len(body) - BODY_LIMIT)
+    msg.attach(MIMEText(body, 'plain'))
+    if attachment is not None:
+        part = MIMEApplication(attachment, 'gzip')
+        part.add_header('Content-Disposition', 'attachment',
+            filename='reports.tar.gz')
+        msg.attach(part)
 
     # Send the email via our own SMTP server.
     s = smtplib.SMTP('localhost')
     s.sendmail(me, to, msg.as_string())
     s.quit()
 
+def results_filename(output_path, branch, config):
+    "Return the JSON lines results file written by test.py for config"
+    return '%s/%s-%s.jsonl' % (output_path, branch, DB_TYPES[config])
+
 def html_filename(output_path, branch, config):
     filename = '%s-%s' % (branch, config)
     filename = '%s/%s.html' % (output_path, filename)
     return filename
 
-def run(args, env):
-    process = subprocess.Popen(args, env=env)
-    process.wait()
+def makedirs(path):
+    "Create the directory path, which other branches may be creating too"
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def start(args, env, log_filename=None):
+    """
+    Start args without waiting for it to finish, sending its output to
+    log_filename if given.
+    """
+    if not log_filename:
+        return subprocess.Popen(args, env=env)
+    log = open(log_filename, 'w')
+    try:
+        return subprocess.Popen(args, env=env, stdout=log,
+            stderr=subprocess.STDOUT)
+    finally:
+        log.close()
 
 def check_output(args, env=None, errors=False):
     process = subprocess.Popen(args, env=env, stdout=subprocess.PIPE,
@@ -183,71 +302,101 @@ def check_output(args, env=None, errors=False):
     return data
 
 
-def get_module_key(filename):
-    uppath = lambda _path, n: os.sep.join(_path.split(os.sep)[:-n])
-    directory = os.path.dirname(filename)
-    i = 0
-    while not os.path.exists(os.path.join(directory,'tryton.cfg')):
-        if directory.split(os.sep)[-1] == 'trytond':
-            return False
-        i+=1
-        if i > 5:
-            return False
-        directory = uppath(directory,i)
-    return directory
+def coverage_filename(branch, config):
+    return '%s/.coverage-%s-%s' % (exec_path, branch, config)
+
+
+def impact_filename(branch, config):
+    return '%s/%s-%s-impact.json' % (cache_path, branch, config)
 
 
 def runtest(path, branch, config, env, coverage, output_path, nereid_path,
-        failfast=False):
+        failfast=False, jobs=1, modules=None, changed=None):
+    """
+    Start test.py for config in background and return its process.
+    Each config gets its own coverage data file and log so several of them
+    can run at the same time. The tests run can be limited to modules or to
+    the ones covering the files listed in the changed file.
+    """
     parameters = ['python', 'test.py', '--name', branch, '--config',
-        '%s.conf' % config, '--output', output_path, '--nereid', nereid_path]
+        '%s.conf' % config, '--output', output_path, '--nereid', nereid_path,
+        '--jobs', str(jobs)]
     if failfast:
         parameters.append('--failfast')
+    if config == 'sqlite':
+        parameters.append('--fast-sqlite')
+    if modules is not None:
+        parameters.append('--modules')
+        parameters.append(','.join(sorted(modules)))
+    makedirs(cache_path)
+    parameters.append('--impact-map')
+    parameters.append(impact_filename(branch, config))
+    if changed is not None:
+        parameters.append('--changed-files')
+        parameters.append(changed)
+    # Branches run at the same time, their databases must not be shared
+    env = dict(env, DB_NAME='test_%s_%s_%d' % (re.sub(r'[^a-z0-9]', '_',
+                branch.lower()), config, int(time.time())))
     if coverage:
         parameters.append('--coverage')
         parameters.append('--coverage-dir')
         parameters.append('%s-%s-coverage' % (branch, config))
-    run(parameters, env)
-    if not coverage:
-        return
+        env = dict(env, COVERAGE_FILE=coverage_filename(branch, config))
+    results = results_filename(output_path, branch, config)
+    if os.path.exists(results):
+        os.remove(results)
+    log_filename = '%s/%s-%s.log' % (output_path, branch, config)
+    logger.info('Running %s, output in %s' % (parameters, log_filename))
+    return start(parameters, env, log_filename)
+
+
+def module_coverage(cov, trytond_path):
+    """
+    Return the {module: (lines, covered)} of the files measured by cov,
+    grouped by their module found in the index of module roots of
+    trytond_path. Files of trytond outside any module are grouped as
+    'trytond' and the ones outside trytond_path are ignored.
+    """
+    trytond_path = os.path.abspath(trytond_path)
+    roots = modulegraph.module_roots(trytond_path)
+    trytond_path = os.path.join(trytond_path, '')
+    if hasattr(cov, 'get_data'):
+        data = cov.get_data()
+    else:
+        data = cov.data
+    records = {}
+    for filename in data.measured_files():
+        if not os.path.normpath(filename).startswith(trytond_path):
+            continue
+        _, module = modulegraph.get_module(roots, filename)
+        try:
+            _, statements, _, missing, _ = cov.analysis2(filename)
+        except Exception:
+            # Source no longer available
+            continue
+        lines, covered = records.get(module or 'trytond', (0, 0))
+        records[module or 'trytond'] = (lines + len(statements),
+            covered + len(statements) - len(missing))
+    return records
+
 
-    # Process coverage information
+def runcoverage(branch, config, env, output_path, trytond_path):
+    "Process coverage information of a finished runtest()"
     from coverage import coverage
-    f = StringIO()
-    cov = coverage()
+    cov = coverage(data_file=coverage_filename(branch, config))
     cov.load()
-    cov.report(file=f, show_missing=False)
-    output = f.getvalue()
     records = {}
     total_lines = 0
     total_covered = 0
-    for line in output.splitlines():
-        if 'trytond' in line:
-            item = re.split(' +', line)
-            filename = item[0]
-            try:
-                lines = int(item[1])
-                uncovered = int(item[2])
-            except ValueError:
-                continue
-            covered = lines - uncovered
-            #key = filename
-            key = get_module_key(filename)
-            if not key:
-                continue
-            #if key.startswith(trytond_path):
-            #    key = key[len(trytond_path):]
-            if not key in records:
-                records[key] = (0, 0)
-            lines += records[key][0]
-            covered += records[key][1]
-            if lines == 0.0:
-                coverage = 100.0
-            else:
-                coverage = 100.0 * float(covered) / float(lines)
-            records[key] = (lines, covered, coverage)
-            total_lines += lines
-            total_covered += covered
+    for module, (lines, covered) in module_coverage(cov,
+            trytond_path).iteritems():
+        if lines == 0:
+            percent = 100.0
+        else:
+            percent = 100.0 * covered / lines
+        records[module] = (lines, covered, percent)
+        total_lines += lines
+        total_covered += covered
 
     if total_lines == 0.0:
         coverage = 100
@@ -314,24 +463,134 @@ def runtest(path, branch, config, env, coverage, output_path, nereid_path,
     #print "COVERAGE: %.2f" % coverage
 
 
-def runflakes(checker, trytond_path, branch, output_path):
+def lint(filenames):
     """
-    Possible values for checker: pyflakes, flake8
+    Run flake8, which includes the pyflakes checks, on filenames and return
+    its findings as records.
     """
-    assert checker in ('pyflakes', 'flake8')
-    row = '<tr class="%(class)s">'
-    row += '<td>%(module)s</td>'
-    row += '<td>%(output)s</td>'
-    row += '<td>%(url)s</td>'
-    row += '</tr>'
+    output = check_output(['flake8', '--ignore=%s' % FLAKE8_IGNORE]
+        + filenames)
+    records = []
+    for line in output.splitlines():
+        match = LINT_LINE.match(line)
+        if not match:
+            if line.strip():
+                logger.warning('Unknown flake8 output: %s' % line)
+            continue
+        filename, lineno, col, code, message = match.groups()
+        records.append({
+                'file': os.path.normpath(filename),
+                'line': int(lineno),
+                'col': int(col or 0),
+                'code': code,
+                'message': message,
+                })
+    return records
+
+
+def python_files(directory):
+    "Return the sorted python files flake8 checks in directory"
+    filenames = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        filenames.extend(os.path.normpath(os.path.join(root, f))
+            for f in files if f.endswith('.py'))
+    return sorted(filenames)
+
+
+class LintCache(object):
+    """
+    Findings of flake8 stored by file content, checker version and ignore
+    options, so files that did not change are not checked again.
+    """
+
+    def __init__(self, version):
+        makedirs(cache_path)
+        self.connection = sqlite3.connect(
+            os.path.join(cache_path, 'lint.sqlite'), timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS lint '
+            '(key TEXT PRIMARY KEY, records TEXT)')
+        self.salt = '\0'.join([version, FLAKE8_IGNORE, ''])
+        self.hits = self.misses = 0
+
+    def key(self, filename):
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(self.salt + f.read()).hexdigest()
+
+    def get(self, key):
+        "Return the records stored for key without file or None"
+        row = self.connection.execute('SELECT records FROM lint '
+            'WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, items):
+        "Store the list of (key, records) in items"
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO lint '
+                '(key, records) VALUES (?, ?)',
+                [(k, json.dumps(r)) for k, r in items])
+
+    def close(self):
+        self.connection.close()
+
+
+def module_url(directory):
+    try:
+        url = open('%s/.hg/hgrc' % directory, 'r').readlines()
+        return url[1].strip('\n').split(' ')[2]
+    except (IOError, IndexError):
+        return ''
 
-    args = []
-    if checker == 'flake8':
-        args = ['--ignore="E120,E121,E123,E124,E126,E127,E128,W0232,R0903"']
 
-    total_modules = 0
+def lint_report(checker, branch, output_path, modules, cache_stats):
+    """
+    Write the report of checker from the (module, url, records) of modules.
+    The pyflakes report only shows the pyflakes (F) codes.
+    """
+    assert checker in ('pyflakes', 'flake8')
+    row = ('<tr class="%(class)s"><td>%(module)s</td>'
+        '<td><pre>%(output)s</pre></td><td>%(url)s</td></tr>')
     total_errors = 0
-    rows = ''
+    rows = []
+    for module, url, records in modules:
+        if checker == 'pyflakes':
+            records = [r for r in records if r['code'].startswith('F')]
+        total_errors += len(records)
+        output = '\n'.join(LINT_FORMAT[checker] % r for r in records)
+        rows.append(row % {
+                'class': 'errorClass' if records else 'passClass',
+                'module': module,
+                'output': cgi.escape(output),
+                'url': url,
+                })
+
+    header = ('<tr id="header_row"><th>Module</th><th>Output</th>'
+        '<th>URL</th></tr>')
+    footer = ('<tr><th>Modules: %d</th><th>Errors: %d</th>'
+        '<th>Cache: %d hits, %d misses</th></tr>'
+        % ((len(modules), total_errors) + cache_stats))
+    title = '%s on branch %s' % (checker, branch)
+    html = ''.join(['<html>', STYLE, '<body>', '<title>%s</title>' % title,
+            '<br/>', '<table id="result_table">', header] + rows
+        + [footer, '</table>', '</body></html>'])
+
+    f = open(html_filename(output_path, branch, checker), 'w')
+    try:
+        f.write(html)
+    finally:
+        f.close()
+
+
+def runflakes(trytond_path, branch, output_path):
+    """
+    Lint every module once and write both the pyflakes and flake8 reports
+    from the same findings. Only files not found in the LintCache are
+    checked.
+    """
     path = '%s/trytond/modules' % trytond_path
     dirs = []
     for f in sorted(os.listdir(path)):
@@ -339,87 +598,320 @@ def runflakes(checker, trytond_path, branch, output_path):
         if not os.path.isdir(p):
             continue
         dirs.append(p)
+
+    cache = LintCache(check_output(['flake8', '--version']).strip())
+    try:
+        files = {}
+        found = {}
+        missing = []
+        for d in dirs:
+            files[d] = [(f, cache.key(f)) for f in python_files(d)]
+            for filename, key in files[d]:
+                records = cache.get(key)
+                if records is None:
+                    missing.append((filename, key))
+                else:
+                    found[filename] = [dict(r, file=filename)
+                        for r in records]
+
+        chunks = [missing[i:i + 50] for i in xrange(0, len(missing), 50)]
+        with lint_lock:
+            pool = multiprocessing.Pool(lint_jobs())
+            try:
+                results = pool.map(lint, [[f for f, _ in c] for c in chunks])
+            finally:
+                pool.close()
+                pool.join()
+        for filename, _ in missing:
+            found[filename] = []
+        for records in results:
+            for record in records:
+                found[record['file']].append(record)
+        cache.set([(key, [dict((k, v) for k, v in r.iteritems()
+                            if k != 'file') for r in found[filename]])
+                for filename, key in missing])
+    finally:
+        cache.close()
+
+    modules = []
     for d in dirs:
-        parameters = [checker, d ] + args
-        output = check_output(parameters)
-        module = os.path.basename(d)
-        try:
-            url = open('%s/.hg/hgrc' % d, 'r').readlines()
-            url = url[1].strip('\n').split(' ')[2]
-        except IOError:
-            url = ''
-
-        # Discard elements from ignore list
-        new = []
-        for x in output.split('\n'):
-            add = True
-            for ignore in FLAKES_IGNORE_LIST:
-                if ignore in x:
-                    add = False
-                    break
-            if add:
-                new.append(x)
-        output = '\n'.join(new)
-
-        if not output:
-            cls = 'passClass'
-        else:
-            cls = 'errorClass'
-        output = '<pre>%s</pre>' % output
-        rows += row % {
-            'class': cls,
-            'module': module,
-            'output': output,
-            'url': url,
-            }
-        total_modules += 1
-        total_errors += len(output.split('\n'))
+        records = [r for f, _ in files[d] for r in found[f]
+            if not FLAKES_IGNORE.search(r['message'])]
+        modules.append((os.path.basename(d), module_url(d), records))
+    for checker in ('pyflakes', 'flake8'):
+        lint_report(checker, branch, output_path, modules,
+            (cache.hits, cache.misses))
 
-    header = '<tr id="header_row">'
-    header += '<th>Module</th>'
-    header += '<th>Output</th>'
-    header += '<th>URL</th>'
-    header += '</tr>'
 
-    footer = '<tr>'
-    footer += '<th>Modules: %d</th>' % total_modules
-    footer += '<th>Errors: %d</th>' % total_errors
-    footer += '<th></th>'
-    footer += '</tr>'
+def revisions(paths):
+    """
+    Return the working directory revision of every repository found in the
+    dictionary of paths as {key: (directory, node)}, where key is the name
+    in paths followed by the directory relative to it.
+    """
+    result = {}
+    for name, path in paths.iteritems():
+        for root, dirs, files in os.walk(path):
+            if '.hg' in dirs:
+                node = check_output(['hg', 'log', '-R', root, '-r', '.',
+                        '--template', '{node}'])
+                key = os.path.normpath(os.path.join(name,
+                        os.path.relpath(root, path)))
+                result[key] = (root, node)
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+    return result
 
-    table = '<table id="result_table">%s%s%s</table>' % (header, rows, footer)
-    html = "<html>"
-    html += STYLE
-    html += "<body>"
-    title = '%s on branch %s' % (checker, branch)
-    html += '<title>%s</title>' % title
-    html += '<br/>'
-    html += table
-    html += '</body></html>'
 
-    f = open(html_filename(output_path, branch, checker), 'w')
+def revisions_filename(branch):
+    return '%s/%s-revisions.json' % (cache_path, branch)
+
+
+def save_revisions(branch, paths):
+    "Store the revisions of paths as the last successful ones of branch"
+    makedirs(cache_path)
+    with open(revisions_filename(branch), 'w') as f:
+        json.dump(dict((k, n) for k, (_, n) in revisions(paths).iteritems()),
+            f, indent=4, sort_keys=True)
+
+
+def changed_files(branch, paths):
+    """
+    Return the files of paths changed since the last successful revisions
+    of branch or None if some repository can not be compared.
+    """
     try:
+        with open(revisions_filename(branch)) as f:
+            old = json.load(f)
+    except (IOError, ValueError):
+        return None
+    files = []
+    for key, (root, node) in revisions(paths).iteritems():
+        if key not in old:
+            return None
+        if old[key] == node:
+            continue
+        try:
+            # hg status lists the files hg diff would show between both
+            output = check_output(['hg', 'status', '-R', root, '--no-status',
+                    '--rev', old[key], '--rev', node])
+        except Exception:
+            return None
+        files.extend(os.path.join(root, f) for f in output.splitlines())
+    return files
+
+
+def save_changed_files(branch, paths):
+    """
+    Write the files changed since the last successful run of branch for
+    test.py --changed-files and return the file name, or None if they are
+    unknown and all the tests must be run.
+    """
+    files = changed_files(branch, paths)
+    if files is None:
+        return None
+    filename = '%s/%s-changed.txt' % (cache_path, branch)
+    with open(filename, 'w') as f:
+        f.writelines('%s\n' % os.path.abspath(name) for name in files)
+    return filename
+
+
+def affected_modules(branch, paths):
+    """
+    Return the modules changed since the last successful run of branch and
+    the ones depending on them, or None if all tests must be run.
+    """
+    files = changed_files(branch, paths)
+    if files is None:
+        return None
+    roots = modulegraph.module_roots(paths['trytond'])
+    proteus_path = paths.get('proteus')
+    modules = set()
+    for filename in files:
+        if proteus_path and filename.startswith(
+                os.path.join(proteus_path, '')):
+            modules.add('proteus')
+            continue
+        _, module = modulegraph.get_module(roots, filename)
+        if module is None:
+            # trytond itself changed
+            return None
+        modules.add(module)
+    logger.info('Modules changed on branch %s: %s' % (branch, modules))
+    return modulegraph.test_groups(modulegraph.dependents(
+            modulegraph.module_dependencies(roots), modules))
+
+
+def trend_table(history, runs, kind, limit=20):
+    """
+    Return the rows of a table with the duration on runs of the limit
+    slowest names of kind on the newest run.
+    """
+    durations = history.durations([r[0] for r in runs], kind)
+    newest = runs[0][0]
+    names = sorted(durations, key=lambda n: durations[n].get(newest, 0),
+        reverse=True)[:limit]
+    header = ''.join('<th>%s<br/>%s</th>' % (cgi.escape(timestamp),
+            cgi.escape(revision)) for _, revision, timestamp in runs)
+    rows = ['<tr id="header_row"><th>%s</th>%s</tr>'
+        % (kind.capitalize(), header)]
+    for name in names:
+        cells = []
+        for run, _, _ in runs:
+            duration = durations[name].get(run)
+            cells.append('<td>%s</td>' % ('%.2fs' % duration
+                    if duration is not None else ''))
+        rows.append('<tr><td>%s</td>%s</tr>' % (cgi.escape(name),
+                ''.join(cells)))
+    return rows
+
+
+def trend_report(history, branch, output_path, configs):
+    "Write the report of the durations of the last runs of configs"
+    body = []
+    for config in configs:
+        runs = history.runs(branch, DB_TYPES[config],
+            limit=options.history_window)
+        if not runs:
+            continue
+        for kind in ('module', 'test'):
+            body.append('<h2>Slowest %ss on %s</h2>' % (kind, config))
+            body.append('<table id="result_table">')
+            body.extend(trend_table(history, runs, kind))
+            body.append('</table>')
+    title = 'Test durations on branch %s' % branch
+    html = ''.join(['<html>', STYLE, '<body>', '<title>%s</title>' % title,
+            '<h1>%s</h1>' % title] + body + ['</body></html>'])
+    with open(html_filename(output_path, branch, 'trend'), 'w') as f:
         f.write(html)
+
+
+def record_history(branch, output_path, configs, revision, now):
+    """
+    Store the test durations of the finished runs of configs in the history,
+    write the trend report of branch and return the regressions found as a
+    list of text lines, empty if there is none or the check is disabled.
+    """
+    makedirs(cache_path)
+    history = History(os.path.join(cache_path, 'history.sqlite'))
+    regressions = []
+    try:
+        for config in configs:
+            filename = results_filename(output_path, branch, config)
+            if read_summary(filename) is None:
+                continue
+            backend = DB_TYPES[config]
+            run = history.add_run(branch, backend, revision,
+                now.strftime('%Y-%m-%d %H:%M:%S'), filename)
+            if options.regression_ratio is None:
+                continue
+            for name, duration, median in history.regressions(run, branch,
+                    backend, options.regression_ratio,
+                    options.history_window):
+                regressions.append('%s: %s took %.2fs, median %.2fs'
+                    % (config, name, duration, median))
+        trend_report(history, branch, output_path, configs)
     finally:
-        f.close()
+        history.close()
+    return regressions
+
+
+def workspace_filename(branch):
+    return '%s/%s-workspace.json' % (cache_path, branch)
+
+
+def load_workspace(branch):
+    "Return the workspace record of the last bootstrap of branch or None"
+    try:
+        with open(workspace_filename(branch)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def save_workspace(branch, url, path):
+    "Store path as the workspace prepared by bootstrap.sh of url for branch"
+    makedirs(cache_path)
+    with open(workspace_filename(branch), 'w') as f:
+        json.dump({
+                'url': url,
+                'path': path,
+                'revisions': dict((k, n) for k, (_, n)
+                    in revisions({'workspace': path}).iteritems()),
+                }, f, indent=4, sort_keys=True)
+
+
+def prepared_workspace(branch, url):
+    """
+    Return the workspace of the last bootstrap of url for branch if none of
+    its repositories changed since, locally or upstream, or None.
+    """
+    workspace = load_workspace(branch)
+    if (workspace is None or workspace['url'] != url
+            or not os.path.isdir(workspace['path'])):
+        return None
+    current = revisions({'workspace': workspace['path']})
+    if set(current) != set(workspace['revisions']):
+        return None
+    for key, (root, node) in current.iteritems():
+        if node != workspace['revisions'][key]:
+            return None
+        try:
+            named = check_output(['hg', 'log', '-R', root, '-r', '.',
+                    '--template', '{branch}'])
+            # Head of the same named branch on the default path
+            remote = check_output(['hg', 'id', '-R', root, '-i', '-r', named,
+                    'default']).strip()
+        except Exception:
+            return None
+        if not remote or not node.startswith(remote):
+            logger.info('%s changed upstream' % key)
+            return None
+    return workspace['path']
 
 
 def clean_old_fetched_dirs(branch, days=3):
     now = time.time()
+    workspace = load_workspace(branch)
     for fullpath in glob.glob('/tmp/%s*' % branch):
+        if workspace and fullpath == workspace['path']:
+            # Kept to be copied while its repositories do not change
+            continue
         if (os.stat(fullpath).st_mtime < (now - days * 24 * 60 * 60)
                 and os.path.isdir(fullpath)):
             shutil.rmtree(fullpath)
             logger.info('Removed %s path' % fullpath)
 
 
-def fetch(url, output_path, branch):
-    test_dir = tempfile.mkdtemp(prefix=branch + '_')
+def hg_env():
+    """
+    Return the environment to run hg with the share extension keeping the
+    history of every repository cloned, also by bootstrap.sh, in a pool under
+    mirrors_path. A clone only pulls the changesets missing from the pool and
+    its working copy uses the pooled store instead of a copy of it.
+    """
+    makedirs(mirrors_path)
+    hgrc = os.path.join(cache_path, 'hgrc')
+    # Written to a temporary file renamed over the old one, as other
+    # branches may be running hg with it
+    fd, tmp = tempfile.mkstemp(dir=cache_path, prefix='hgrc-')
+    with os.fdopen(fd, 'w') as f:
+        f.write('[extensions]\nshare =\n\n[share]\npool = %s\n'
+            % mirrors_path)
+    os.rename(tmp, hgrc)
+    paths = [p for p in ('/etc/mercurial/hgrc', '/etc/mercurial/hgrc.d',
+            os.path.expanduser('~/.hgrc')) if os.path.exists(p)]
+    return dict(os.environ, HGRCPATH=os.pathsep.join(paths + [hgrc]))
+
+
+def bootstrap(url, test_dir):
+    "Clone url into test_dir, run its bootstrap.sh and return their output"
     cwd = os.getcwd()
     logger.info('Cloning %s into %s' % (url, test_dir))
     output = 'Cloning %s into %s\n' % (url, test_dir)
+    env = hg_env()
     try:
-        output += check_output(['hg', 'clone', url, test_dir], errors=True)
+        output += check_output(['hg', 'clone', url, test_dir], env=env,
+            errors=True)
     except Exception, e:
         output += 'Error running hg clone: ' + str(e) + '\n'
         send_mail("[Tests] Error running hg clone", output)
@@ -428,7 +920,7 @@ def fetch(url, output_path, branch):
     logger.info('Runninig ./bootstrap.sh')
     output += '\nRunninig ./bootstrap.sh\n'
     try:
-        output += check_output(['./bootstrap.sh'], errors=True)
+        output += check_output(['./bootstrap.sh'], env=env, errors=True)
         logger.debug("./bootstrap.sh executed OK")
     except Exception, e:
         output += '\nError runnig ./bootstrap.sh:\n' + str(e) + '\n'
@@ -436,6 +928,29 @@ def fetch(url, output_path, branch):
         sys.exit('Error running ./bootstrap.sh')
     finally:
         os.chdir(cwd)
+    return output
+
+
+def fetch(url, output_path, branch):
+    test_dir = tempfile.mkdtemp(prefix=branch + '_')
+    prepared = prepared_workspace(branch, url)
+    if prepared is not None:
+        logger.info('Copying unchanged workspace %s into %s'
+            % (prepared, test_dir))
+        output = ('Repositories unchanged since the last bootstrap, copying '
+            '%s into %s\n' % (prepared, test_dir))
+        try:
+            os.rmdir(test_dir)
+            # Hard links, the files of the workspace are not modified
+            output += check_output(['cp', '-al', prepared, test_dir])
+        except Exception, e:
+            output += 'Error copying workspace: %s\n' % e
+            shutil.rmtree(test_dir, ignore_errors=True)
+            os.mkdir(test_dir)
+            prepared = None
+    if prepared is None:
+        output = bootstrap(url, test_dir)
+        save_workspace(branch, url, test_dir)
 
     f = open(html_filename(output_path, branch, 'fetch'), 'w')
     try:
@@ -448,110 +963,306 @@ def fetch(url, output_path, branch):
     finally:
         f.close()
     # TODO: Currently we have hardcoded trytond and proteus subdirs
-    return os.path.join(test_dir, 'trytond'), os.path.join(test_dir, 'proteus'),
-        os.path.join(test_dir, 'nereid_app')
-
-def success(branch, ouput_path):
-    success=True
-
-    from BeautifulSoup import BeautifulSoup
-    #check sql_lite
-    sqllite_filename="%s/%s-sqlite.html" % (output_path, branch)
-    if not os.path.exists(sqllite_filename):
-        return False
-    sql_lite = open(sqllite_filename, 'r' ).read()
-    parsed_html = BeautifulSoup(sql_lite)
-    error = parsed_html.body.find(id='total_error')
-    fail = parsed_html.body.find(id='total_fail')
-
-    if error or fail:
-        success = False
-    #check postgresq
-    postgres_filename="%s/%s-postgresql.html" % (output_path, branch)
-    if not os.path.exists(postgres_filename):
-        return False
-    html = open(postgres_filename, 'r' ).read()
-    parsed_html = BeautifulSoup(html)
-    error = parsed_html.body.find(id='total_error')
-    fail = parsed_html.body.find(id='total_fail')
-    if error or fail:
-        success = False
-
-    return success
+    return (os.path.join(test_dir, 'trytond'),
+        os.path.join(test_dir, 'proteus'),
+        os.path.join(test_dir, 'nereid_app'))
+
+def read_summary(filename):
+    """
+    Return the summary written at the end of a test.py results file or None
+    if the file is missing or the run did not finish.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            f.seek(0, 2)
+            f.seek(max(f.tell() - 4096, 0))
+            lines = f.read().splitlines()
+    except IOError:
+        return None
+    try:
+        summary = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        return None
+    if summary.get('type') != 'summary':
+        return None
+    return summary
 
 
-if __name__ == "__main__":
-    for branch, values in settings.iteritems():
-        if options.branch and branch != options.branch:
+def success(branch, output_path, configs):
+    """
+    Return if the test runs of configs finished without failures nor errors
+    and a text summary of them.
+    """
+    success = True
+    text = []
+    for config in configs:
+        summary = read_summary(results_filename(output_path, branch, config))
+        if summary is None:
+            success = False
+            text.append('%s: no results' % config)
             continue
-        nereid_path = values.get('nereid')
-        sys.path.insert(0, nereid_path)
+        if summary['fail'] or summary['error']:
+            success = False
+        text.append('%s: %d tests, %d failures, %d errors in %ds' % (config,
+                summary['count'], summary['fail'], summary['error'],
+                summary['duration']))
+    return success, '\n'.join(text)
 
-        now = datetime.now()
-        logger.info("Starting runtests for branch '%s' with values '%s'"
-            % (branch, values))
-        try:
-            if values.get('output'):
-                output_path = values['output']
-            else:
-                output_path = '/home/%s/public_html' % getpass.getuser()
-            if values.get('add_timestamp'):
-                output_path = os.path.join(output_path,
-                    now.strftime('%Y-%m-%d_%H:%M:%S'))
-                os.mkdir(output_path)
-            public_path = os.path.dirname(output_path + "/")
-            if 'html' in public_path.split('/')[-1]:
-                public_path = ''
-
-            ch = logging.FileHandler(output_path + '/runtests.log')
-            ch.setLevel(logging.DEBUG)
-            ch.setFormatter(logging.Formatter(
-                    '[%(asctime)s] %(levelname)s:%(message)s'))
-            logger.addHandler(ch)
-
-            clean_old_fetched_dirs(branch)
-
-            logger.debug("output_path='%s', values['url']='%s'"
-                % (output_path, values.get('url')))
-            if values.get('url'):
-                values['trytond'], values['proteus'], values['nereid'] = \
-                        fetch(values['url'], output_path, branch)
-
-            trytond_path = values['trytond']
-            if not os.path.isdir(trytond_path):
-                continue
 
-            execution_name = "%s %s" % (now.strftime('%Y-%m-%d %H:%M:%S'), branch)
-            pythonpath = [trytond_path]
-            if 'proteus' in values:
-                pythonpath.append(values['proteus'])
-
-            if 'nereid' in values:
-                pythonpath.append(values['nereid'])
-            env = {
-                'PYTHONPATH': ':'.join(pythonpath)
-                }
-            if not options.unittest_only:
-                runflakes('pyflakes', trytond_path, branch, output_path)
-                runflakes('flake8', trytond_path, branch, output_path)
-            if options.flakes_only:
+def failed_tests(filename):
+    "Return the (id, status) of the tests which did not pass in filename"
+    result = []
+    try:
+        with open(filename) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('type') == 'test' and record['status'] != 'pass':
+                    result.append((record['id'], record['status']))
+    except IOError:
+        pass
+    return result
+
+
+def digest(branch, output_path, configs, url):
+    """
+    Return the text lines with the tests which did not pass on configs, the
+    ones which passed on the previous run of the history first, and the
+    links to the reports published at url.
+    """
+    lines = []
+    history = History(os.path.join(cache_path, 'history.sqlite'))
+    try:
+        for config in configs:
+            filename = results_filename(output_path, branch, config)
+            failed = failed_tests(filename)
+            if not failed:
                 continue
-            if not options.pgsql_only:
-                runtest(trytond_path, branch, 'sqlite', env, options.coverage,
-                    output_path, nereid_path,  options.failfast)
-            if not options.sqlite_only:
-                runtest(trytond_path, branch, 'postgres', env, options.coverage,
-                    output_path, nereid_path, options.failfast)
-        except Exception as e:
+            runs = history.runs(branch, DB_TYPES[config], limit=2)
+            if read_summary(filename) is not None:
+                # The first one is this run
+                runs = runs[1:]
+            previous = history.statuses(runs[0][0]) if runs else {}
+            new = [t for t in failed if previous.get(t[0]) == 'pass']
+            lines.append('')
+            lines.append('%s: %d tests not passing, %d new' % (config,
+                    len(failed), len(new)))
+            lines.extend('  new %s: %s' % (s, t) for t, s in new)
+            lines.extend('  %s: %s' % (s, t) for t, s in failed
+                if (t, s) not in new)
+    finally:
+        history.close()
+    lines.append('')
+    lines.append('Reports:')
+    for filename in sorted(glob.glob('%s/*.html' % output_path)):
+        lines.append(url + os.path.basename(filename))
+    return lines
+
+
+def run_branch(branch, values):
+    nereid_path = values.get('nereid')
+    sys.path.insert(0, nereid_path)
+
+    now = datetime.now()
+    logger.info("Starting runtests for branch '%s' with values '%s'"
+        % (branch, values))
+    try:
+        if values.get('output'):
+            output_path = values['output']
+        else:
+            output_path = '/home/%s/public_html' % getpass.getuser()
+        if values.get('add_timestamp'):
+            output_path = os.path.join(output_path,
+                now.strftime('%Y-%m-%d_%H:%M:%S'))
+            os.mkdir(output_path)
+        public_path = os.path.dirname(output_path + "/")
+        if 'html' in public_path.split('/')[-1]:
+            public_path = ''
+
+        ch = logging.FileHandler(output_path + '/runtests.log')
+        ch.setLevel(logging.DEBUG)
+        ch.setFormatter(logging.Formatter(
+                '[%(asctime)s] %(levelname)s:%(message)s'))
+        logger.addHandler(ch)
+
+        clean_old_fetched_dirs(branch)
+
+        logger.debug("output_path='%s', values['url']='%s'"
+            % (output_path, values.get('url')))
+        if values.get('url'):
+            values['trytond'], values['proteus'], values['nereid'] = \
+                    fetch(values['url'], output_path, branch)
+
+        trytond_path = values['trytond']
+        if not os.path.isdir(trytond_path):
+            return
+
+        execution_name = "%s %s" % (now.strftime('%Y-%m-%d %H:%M:%S'), branch)
+        pythonpath = [trytond_path]
+        if 'proteus' in values:
+            pythonpath.append(values['proteus'])
+
+        if 'nereid' in values:
+            pythonpath.append(values['nereid'])
+        env = {
+            'PYTHONPATH': ':'.join(pythonpath)
+            }
+        paths = {'trytond': trytond_path}
+        if values.get('proteus'):
+            paths['proteus'] = values['proteus']
+        modules = None
+        if options.affected_only:
+            modules = affected_modules(branch, paths)
+        changed = None
+        if options.impacted_only:
+            changed = save_changed_files(branch, paths)
+        if not options.unittest_only:
+            runflakes(trytond_path, branch, output_path)
+        if options.flakes_only:
+            return
+        processes = []
+        if not options.pgsql_only:
+            processes.append(('sqlite', runtest(trytond_path, branch,
+                        'sqlite', env, options.coverage, output_path,
+                        nereid_path, options.failfast, options.jobs,
+                        modules, changed)))
+        if not options.sqlite_only:
+            processes.append(('postgres', runtest(trytond_path, branch,
+                        'postgres', env, options.coverage, output_path,
+                        nereid_path, options.failfast, options.jobs,
+                        modules, changed)))
+        for config, process in processes:
+            process.wait()
+            logger.info('%s tests finished with code %s'
+                % (config, process.returncode))
+            if options.coverage:
+                runcoverage(branch, config, env, output_path, trytond_path)
+    except Exception as e:
+        send_mail("[Tests] Error executing test %s" % execution_name,
+            "%s.\nMaybe there is any output at %s%s"
+            % (str(e), REPORTS_URL, public_path),
+            ch.baseFilename, output_path)
+    else:
+        configs = [config for config, _ in processes]
+        ok, summary = success(branch, output_path, configs)
+        try:
+            revision = check_output(['hg', 'log', '-R', trytond_path, '-r',
+                    '.', '--template', '{node|short}'])
+        except Exception:
+            revision = ''
+        regressions = record_history(branch, output_path, configs, revision,
+            now)
+        if regressions:
+            ok = False
+            summary += '\n\nDuration regressions:\n' + '\n'.join(regressions)
+        url = '%s%s' % (REPORTS_URL, os.path.join(public_path, ''))
+        summary += '\n'.join(digest(branch, output_path, configs, url))
+        if not ok:
             send_mail("[Tests] Error executing test %s" % execution_name,
-                "%s.\nMaybe there is any output at "
-                "http://tests.nan-tic.com/%s" % (str(e), public_path),
-                ch.baseFilename, output_path)
+            summary, ch.baseFilename, output_path)
         else:
-            if not success(branch, public_path):
-                send_mail("[Tests] Error executing test %s" % execution_name,"",
-                ch.baseFilename, output_path)
-            else:
-                send_mail("[Tests] Successful test execution %s" % execution_name,
-                "Check the output at http://tests.nan-tic.com/%s" % public_path,
-                          ch.baseFilename, output_path)
+            save_revisions(branch, paths)
+            send_mail("[Tests] Successful test execution %s" % execution_name,
+            summary, ch.baseFilename, output_path)
+
+
+def total_memory():
+    "Return the total memory of the machine in MB or None if unknown"
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) // 1024
+    except IOError:
+        pass
+
+
+def db_maxconn():
+    "Return the connections each trytond process may open at most"
+    config = ConfigParser.ConfigParser()
+    config.read(os.path.join(menu_path, 'postgres.conf'))
+    try:
+        return config.getint('options', 'db_maxconn')
+    except (ConfigParser.Error, ValueError):
+        # trytond default
+        return 64
+
+
+# Only one branch runs runflakes() at a time, so its pool is counted once
+lint_lock = multiprocessing.Lock()
+
+
+def lint_jobs():
+    "Return the processes used by runflakes(), at most --max-processes"
+    return max(min(options.lint_jobs, options.max_processes), 1)
+
+
+def lint_resources():
+    "Return the (processes, memory, connections) of the lint pool"
+    if options.unittest_only:
+        return (0, 0, 0)
+    return (lint_jobs(), lint_jobs() * options.process_memory, 0)
+
+
+def branch_resources():
+    """
+    Return the (processes, memory, connections) needed by the tests of
+    run_branch(), the lint pool is not part of them
+    """
+    if options.flakes_only:
+        return (0, 0, 0)
+    backends = 2
+    if options.sqlite_only or options.pgsql_only:
+        backends = 1
+    processes = backends * options.jobs
+    connections = 0
+    if not options.sqlite_only:
+        connections = options.jobs * min(db_maxconn(), PROCESS_CONNECTIONS)
+    return (processes, processes * options.process_memory, connections)
+
+
+def schedule(branches):
+    """
+    Run each (branch, values) of branches in its own process, starting as
+    many of them at the same time as the process, memory and PostgreSQL
+    connection limits allow, once the lint pool is taken from them. A
+    branch is always started when nothing else is running, even if it needs
+    more than the limits.
+    """
+    max_memory = options.max_memory or total_memory() or sys.maxint
+    limits = [l - n for l, n in zip((options.max_processes, max_memory,
+                options.max_connections), lint_resources())]
+    needs = branch_resources()
+    if len(branches) > 1 and any(2 * n > l for n, l in zip(needs, limits)):
+        logger.warning('Branches will run one at a time: two of them need '
+            '%s (processes, memory, connections) but only %s are left by '
+            'the lint pool' % (tuple(2 * n for n in needs), tuple(limits)))
+    pending = list(branches)
+    running = []
+    while pending or running:
+        for process in running[:]:
+            if not process.is_alive():
+                process.join()
+                running.remove(process)
+                logger.info("Branch '%s' finished with code %s"
+                    % (process.name, process.exitcode))
+        while pending:
+            used = [len(running) * n for n in needs]
+            if running and any(u + n > l
+                    for u, n, l in zip(used, needs, limits)):
+                break
+            branch, values = pending.pop(0)
+            process = multiprocessing.Process(target=run_branch,
+                args=(branch, values), name=branch)
+            process.start()
+            logger.info("Branch '%s' started, %d running, %d pending"
+                % (branch, len(running) + 1, len(pending)))
+            running.append(process)
+        time.sleep(1)
+
+
+if __name__ == "__main__":
+    schedule([(branch, values) for branch, values in settings.iteritems()
+            if not options.branch or branch == options.branch])
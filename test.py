@@ -2,14 +2,26 @@
 import logging
 logging.basicConfig(level=logging.FATAL)
 import HTMLTestRunner
+import __builtin__
 import unittest
+import doctest
+import fcntl
 import getpass
+import heapq
+import inspect
+import json
 import sys
 import optparse
 import functools
 import os
+import re
 import shutil
+import subprocess
+import tempfile
+import time
+import traceback
 
+import modulegraph
 
 options = {}
 parser = optparse.OptionParser()
@@ -25,6 +37,42 @@ parser.add_option('', '--nereid', dest="nereid",
     help="path to nereid to add on pythonpath")
 parser.add_option('', '--failfast', action='store_true', dest='failfast',
     help="stop after the first error or failure")
+parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+    help="number of worker processes the modules are split on, "
+    "with trytond 2.8 to 3.2")
+parser.add_option('', '--output-limit', dest='output_limit', type='int',
+    default=HTMLTestRunner.OUTPUT_LIMIT,
+    help="bytes of the output of each test kept for the report")
+parser.add_option('', '--modules', dest='modules',
+    help="comma separated list of modules to test instead of all of them")
+parser.add_option('', '--durations', dest='durations',
+    help="file with the duration of each module used to balance --jobs "
+    "workers (default: ~/.tryton-tests-cache/<name>-<db_type>-durations.json)")
+parser.add_option('', '--no-template', action='store_true',
+    dest='no_template', help="do not create the test databases from a "
+    "template database with ir and res installed")
+parser.add_option('', '--fast-sqlite', action='store_true',
+    dest='fast_sqlite', help="keep the SQLite test databases in /dev/shm "
+    "and do not sync them to disk")
+parser.add_option('', '--impact-map', dest='impact_map',
+    help="file with the files covered by each test, updated on --coverage "
+    "runs")
+parser.add_option('', '--changed-files', dest='changed_files',
+    help="file with the paths changed, one per line, to only run the tests "
+    "of --impact-map covering them")
+parser.add_option('', '--watch', action='store_true', dest='watch',
+    help="keep running and test again the modules whose files change and "
+    "the ones depending on them")
+parser.add_option('', '--profile-startup', action='store_true',
+    dest='profile_startup', help="add the time of each startup phase and of "
+    "the slowest imports to the report")
+parser.add_option('', '--profile', action='store_true', dest='profile',
+    help="profile each test and write the profiles of each test class and "
+    "module, linked from the report")
+parser.add_option('', '--shard', dest='shard',
+    help="comma separated list of modules to run as a --jobs worker")
+parser.add_option('', '--shard-output', dest='shard_output',
+    help="file where a --jobs worker stores its results")
 (opt, _) = parser.parse_args()
 if opt.config:
     options['configfile'] = opt.config
@@ -40,29 +88,789 @@ options['coverage_dir'] = opt.coverage_dir
 options['output'] = opt.output
 options['failfast'] = opt.failfast
 options['nereid'] = opt.nereid
+options['jobs'] = opt.jobs
+options['output_limit'] = opt.output_limit
+options['durations'] = opt.durations
+options['no_template'] = opt.no_template
+options['fast_sqlite'] = opt.fast_sqlite
+options['impact_map'] = opt.impact_map
+options['changed_files'] = opt.changed_files
+options['watch'] = opt.watch
+options['profile_startup'] = opt.profile_startup
+options['profile'] = opt.profile
+options['shard'] = opt.shard
+options['shard_output'] = opt.shard_output
+if opt.modules is not None:
+    options['modules'] = set(m for m in opt.modules.split(',') if m)
+else:
+    options['modules'] = None
+if options['watch'] and options['coverage']:
+    parser.error('--watch can not be used with --coverage')
+
+# (phase, seconds) of the startup until the tests run
+startup = []
+
+
+def phase(name, start):
+    "Record the time spent on the startup phase name since start"
+    startup.append((name, time.time() - start))
+
+
+class ImportProfiler(object):
+    """
+    Replacement of __import__ measuring the time spent on the modules added
+    to sys.modules by each import, with the modules imported by them
+    (cumulative) and without them. The modules are keyed by their absolute
+    name, whatever the name given to the import statement.
+    """
+
+    def __init__(self):
+        self.original = __builtin__.__import__
+        # modules: [cumulative, self]
+        self.times = {}
+        # [time spent on the imports done, modules added] by each import
+        # running
+        self.stack = []
+        self.seen = set(sys.modules)
+        self.count = len(sys.modules)
+
+    def install(self):
+        __builtin__.__import__ = self
+
+    def uninstall(self):
+        __builtin__.__import__ = self.original
+
+    def added(self):
+        "Return the modules added to sys.modules since the last call"
+        if len(sys.modules) == self.count:
+            return []
+        self.count = len(sys.modules)
+        # the None entries are the misses of the implicit relative imports
+        modules = [m for m, v in sys.modules.items()
+            if m not in self.seen and v is not None]
+        self.seen.update(sys.modules)
+        return modules
+
+    def __call__(self, name, *args, **kwargs):
+        # the modules added so far belong to the import running, as this
+        # one is done by their body
+        if self.stack:
+            self.stack[-1][1].extend(self.added())
+        start = time.time()
+        self.stack.append([0.0, []])
+        try:
+            return self.original(name, *args, **kwargs)
+        finally:
+            children, modules = self.stack.pop()
+            modules.extend(self.added())
+            elapsed = time.time() - start
+            if modules:
+                if self.stack:
+                    self.stack[-1][0] += elapsed
+                times = self.times.setdefault(', '.join(sorted(modules)),
+                    [0.0, 0.0])
+                times[0] += elapsed
+                times[1] += elapsed - children
+
+profiler = None
+if options['profile_startup']:
+    profiler = ImportProfiler()
+    profiler.install()
 
 if options['coverage']:
     # If coverage is enabled we want to start
     # it before any trytond imports
     from coverage import coverage
-    cov = coverage()
+    # --jobs workers write their own data file, combined by the parent
+    cov = coverage(data_suffix=bool(options['shard']))
     cov.start()
 
 sys.path.insert(0, 'trytond')
 sys.path.insert(0, options['nereid'])
+sys.path.insert(0, 'proteus')
+start = time.time()
 from trytond.config import CONFIG
+phase('import trytond.config', start)
 
 
+start = time.time()
 CONFIG.update_etc(options['configfile'])
 update_etc = functools.partial(CONFIG.update_etc, options['configfile'])
 CONFIG.update_etc = lambda *args, **kwargd: update_etc()
 CONFIG.update_cmdline(options)
 CONFIG.update_cmdline = lambda *args, **kwargs: None
+phase('configuration', start)
 
-import trytond.tests.test_tryton as test_tryton
 
-sys.path.insert(0, 'proteus')
-import proteus.tests
+def test_module(test):
+    """
+    Return the trytond module a test belongs to. Tests which are not part of
+    a module are grouped as 'trytond' or 'proteus'.
+    """
+    if isinstance(test, doctest.DocTestCase):
+        parts = test._dt_test.filename.split(os.sep)
+        if 'modules' in parts[:-2]:
+            index = len(parts) - parts[::-1].index('modules')
+            return parts[index]
+        return 'trytond'
+    parts = test.__class__.__module__.split('.')
+    if parts[:2] == ['trytond', 'modules'] and len(parts) > 2:
+        return parts[2]
+    if parts[0] == 'proteus':
+        return 'proteus'
+    return 'trytond'
+
+
+def iter_tests(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for test in iter_tests(test):
+                yield test
+        else:
+            yield test
+
+
+def trytond_root():
+    "Return the directory of the trytond repository"
+    import trytond
+    return os.path.dirname(os.path.dirname(os.path.abspath(trytond.__file__)))
+
+
+def trytond_revision():
+    "Return the revision of the trytond repository or None if unknown"
+    try:
+        process = subprocess.Popen(['hg', 'log', '-R', trytond_root(), '-r',
+                '.',
+                '--template', '{node|short}'], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    revision, _ = process.communicate()
+    if process.returncode or not revision:
+        return None
+    return revision
+
+
+def database_class():
+    "Return the Database class of the backend of CONFIG"
+    try:
+        from trytond import backend
+        return backend.get('Database')
+    except (ImportError, AttributeError):
+        from trytond.backend import Database
+        return Database
+
+
+def database_name():
+    """
+    Return the name of the test database given in DB_NAME, as runtests.py
+    does with the branch and backend, or a new one.
+    """
+    name = os.environ.get('DB_NAME')
+    if not name or name == ':memory:':
+        name = 'test_%d' % int(time.time())
+    return name
+
+
+def drop_database(name):
+    "Drop the test database name if it exists"
+    if name == ':memory:':
+        return
+    if CONFIG['db_type'] == 'sqlite':
+        path = os.path.join(CONFIG['data_path'], name + '.sqlite')
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    database = database_class()().connect()
+    cursor = database.cursor(autocommit=True)
+    try:
+        cursor.execute('DROP DATABASE IF EXISTS "%s"' % name)
+        cursor.commit()
+    finally:
+        cursor.close()
+
+
+def drop_test_database():
+    """
+    Drop the database test_tryton used in this process, once its connections
+    are closed
+    """
+    test_tryton = sys.modules.get('trytond.tests.test_tryton')
+    if test_tryton is None or test_tryton.DB_NAME == ':memory:':
+        return
+    try:
+        database_class()(test_tryton.DB_NAME).close()
+        drop_database(test_tryton.DB_NAME)
+    except Exception:
+        traceback.print_exc()
+
+
+def use_database_name(test_tryton):
+    """
+    Make test_tryton use the database given in DB_NAME, which trytond 3.0
+    and older ignore, before the tests import its DB_NAME
+    """
+    name = os.environ.get('DB_NAME')
+    if not name or test_tryton.DB_NAME == name:
+        return
+    test_tryton.DB_NAME = name
+    if hasattr(test_tryton, 'DB'):
+        test_tryton.DB = database_class()(name)
+    if hasattr(test_tryton, 'POOL'):
+        from trytond.pool import Pool
+        test_tryton.POOL = Pool(name)
+
+
+def check_database_name(test_tryton):
+    """
+    Raise if a test would not use the database given in DB_NAME, as it
+    could be shared with other processes and would not be dropped
+    """
+    name = os.environ.get('DB_NAME') or test_tryton.DB_NAME
+    for module in [test_tryton] + [m for n, m in sys.modules.items()
+            if m is not None and n.startswith('trytond.modules.')]:
+        if getattr(module, 'DB_NAME', name) != name:
+            raise RuntimeError('%s uses the database %s instead of %s'
+                % (module.__name__, module.DB_NAME, name))
+
+
+def use_template_database(test_tryton):
+    """
+    Make the create() of the dispatcher, called by test_tryton.install_module()
+    to create the test database, copy it from a template one with ir and res
+    already installed, built only once for each revision of trytond, instead
+    of installing them on every database. PostgreSQL databases are created
+    with the template and SQLite ones are file copies.
+    """
+    create = getattr(test_tryton, 'create', None)
+    revision = trytond_revision()
+    if create is None or revision is None:
+        return
+    Database = database_class()
+    from trytond.pool import Pool
+
+    prefix = 'test_template_%s_' % re.sub(r'[^a-z0-9]', '_',
+        (options['name'] or '').lower())
+    template = prefix + revision
+    sqlite = CONFIG['db_type'] == 'sqlite'
+
+    def sqlite_path(name):
+        return os.path.join(CONFIG['data_path'], name + '.sqlite')
+
+    def execute(*queries):
+        if sqlite:
+            return [f[:-len('.sqlite')] for f in os.listdir(
+                    CONFIG['data_path']) if f.endswith('.sqlite')]
+        database = Database().connect()
+        cursor = database.cursor(autocommit=True)
+        try:
+            for query in queries:
+                cursor.execute(query)
+            cursor.commit()
+            Database._list_cache = None
+            return database.list(cursor)
+        finally:
+            cursor.close()
+
+    def build_template(password, lang, admin_password):
+        # Workers and other runs of the same branch share the template
+        lock = open(os.path.join(tempfile.gettempdir(),
+                '%s.lock' % template), 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            databases = execute()
+            if template in databases:
+                return
+            # Templates of older revisions of the branch, not of the
+            # branches whose name starts with the name of this one
+            old = [d for d in databases if re.match(
+                    re.escape(prefix) + '[0-9a-f]{12}$', d)]
+            if sqlite:
+                for name in old:
+                    os.remove(sqlite_path(name))
+            else:
+                execute(*['DROP DATABASE "%s"' % d for d in old])
+            create(template, password, lang, admin_password)
+            # PostgreSQL does not copy a database with open connections
+            Database(template).close()
+        finally:
+            lock.close()
+
+    def create_from_template(name, password, lang, admin_password):
+        if name in execute():
+            return
+        build_template(password, lang, admin_password)
+        if sqlite:
+            shutil.copyfile(sqlite_path(template), sqlite_path(name))
+        else:
+            execute('CREATE DATABASE "%s" TEMPLATE "%s"' % (name, template))
+        Pool(name).init()
+
+    test_tryton.create = create_from_template
+
+
+def use_fast_sqlite():
+    """
+    Store the SQLite databases, and their template, in shared memory and
+    open them without waiting for the data to reach the disk, as test
+    databases are dropped anyway.
+    """
+    if os.path.isdir('/dev/shm'):
+        data_path = '/dev/shm/tryton-tests-%s' % getpass.getuser()
+        if not os.path.isdir(data_path):
+            os.makedirs(data_path)
+        CONFIG['data_path'] = data_path
+    Database = database_class()
+    connect = Database.connect
+
+    def fast_connect(self):
+        # connect() returns the cached connection once opened, which may be
+        # in a transaction where the PRAGMAs are not allowed
+        opened = getattr(self, '_conn', None) is not None
+        database = connect(self)
+        conn = getattr(self, '_conn', None)
+        if not opened and conn is not None:
+            conn.execute('PRAGMA synchronous = OFF')
+            conn.execute('PRAGMA journal_mode = MEMORY')
+        return database
+    Database.connect = fast_connect
+
+
+def build_suite(modules=None):
+    "Return the suite of all tests or only of the given modules"
+    start = time.time()
+    import trytond.tests.test_tryton as test_tryton
+    phase('import trytond.tests.test_tryton', start)
+    use_database_name(test_tryton)
+    if (not options['no_template'] and (CONFIG['db_type'] == 'postgresql'
+                or test_tryton.DB_NAME != ':memory:')):
+        use_template_database(test_tryton)
+    start = time.time()
+    import proteus.tests
+    phase('import proteus.tests', start)
+
+    start = time.time()
+    if modules is None or 'modules' not in inspect.getargspec(
+            test_tryton.modules_suite).args:
+        suite = test_tryton.modules_suite()
+        suite.addTests(proteus.tests.test_suite())
+    else:
+        suite = selected_suite(test_tryton, modules)
+    phase('build suite', start)
+    check_database_name(test_tryton)
+    if profiler is not None:
+        profiler.uninstall()
+    if modules is not None:
+        suite = unittest.TestSuite(t for t in iter_tests(suite)
+            if test_module(t) in modules)
+    if options['impact_map'] and options['changed_files']:
+        with open(options['changed_files']) as f:
+            changed = [l.strip() for l in f if l.strip()]
+        suite = impacted_tests(suite, load_impact_map(options['impact_map']),
+            changed)
+    return suite
+
+
+def selected_suite(test_tryton, modules):
+    """
+    Return the suite of the given modules, importing only their tests with
+    the modules argument of modules_suite(), which keeps its removal of the
+    duplicated tests and its ordering
+    """
+    suite = unittest.TestSuite()
+    if 'trytond' in modules:
+        suite.addTests(test_tryton.all_suite())
+    others = [m for m in modules if m not in ('trytond', 'proteus')]
+    # modules_suite() returns all the tests without modules
+    if others:
+        suite.addTests(test_tryton.modules_suite(others))
+    if 'proteus' in modules:
+        import proteus.tests
+        suite.addTests(proteus.tests.test_suite())
+    return suite
+
+
+def load_impact_map(filename):
+    "Return the {test id: files} stored in filename, empty if unknown"
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    files = data['files']
+    return dict((test, set(files[i] for i in indexes))
+        for test, indexes in data['tests'].iteritems())
+
+
+def save_impact_map(filename, cov):
+    """
+    Update filename with the files, relative to trytond_root(), covered by
+    each test recorded as a coverage context of its module and id. The files
+    covered only outside of the tests, as when they are imported, are
+    added to the tests of their module. The file names are stored once and
+    referenced by their index.
+    """
+    root = trytond_root()
+    roots = modulegraph.module_roots(root)
+    proteus_path = os.path.join(os.path.abspath('proteus'), '')
+    data = cov.get_data()
+    impact = load_impact_map(filename)
+    recorded = {}
+    tests = {}
+    imported = []
+    for path in data.measured_files():
+        name = os.path.relpath(path, root)
+        contexts = set().union(*data.contexts_by_lineno(path).itervalues())
+        contexts.discard('')
+        if not contexts:
+            imported.append(path)
+        for context in contexts:
+            module, test = context.split(' ', 1)
+            tests.setdefault(module, set()).add(test)
+            recorded.setdefault(test, set()).add(name)
+    for path in imported:
+        if path.startswith(proteus_path):
+            module = 'proteus'
+        else:
+            _, module = modulegraph.get_module(roots, path)
+            if module is None or module in modulegraph.CORE_MODULES:
+                module = 'trytond'
+        for test in tests.get(module, ()):
+            recorded[test].add(os.path.relpath(path, root))
+    impact.update(recorded)
+    files = sorted(set().union(*impact.values()))
+    index = dict((f, i) for i, f in enumerate(files))
+    with open(filename, 'w') as f:
+        json.dump({
+                'files': files,
+                'tests': dict((test, sorted(index[n] for n in names))
+                    for test, names in impact.iteritems()),
+                }, f, separators=(',', ':'))
+
+
+def impacted_tests(suite, impact, changed):
+    """
+    Return the tests of suite covering one of the changed files according
+    to impact, the ones missing from it and the tests of the modules with
+    changed files which are not Python ones, as they are not measured.
+    Return suite if a file outside of the modules changed.
+    """
+    root = trytond_root()
+    roots = modulegraph.module_roots(root)
+    changed = set(os.path.relpath(f, root) for f in changed)
+    modules = set()
+    for filename in changed:
+        if filename.endswith('.py'):
+            continue
+        _, module = modulegraph.get_module(roots, os.path.join(root, filename))
+        if module is None:
+            return suite
+        modules.add(module)
+    modules = modulegraph.test_groups(modules)
+    return unittest.TestSuite(t for t in iter_tests(suite)
+        if t.id() not in impact or impact[t.id()] & changed
+        or test_module(t) in modules)
+
+
+def add_startup_sections(runner, limit=50):
+    "Add the startup phases and the limit slowest imports to runner report"
+    if profiler is None:
+        return
+    runner.addSection('Startup phases', ['Phase', 'Time'],
+        [(name, HTMLTestRunner.formatTime(seconds))
+            for name, seconds in startup])
+    imports = sorted(profiler.times.iteritems(), key=lambda i: i[1][0],
+        reverse=True)[:limit]
+    runner.addSection('Top %d slowest imports' % len(imports),
+        ['Modules', 'Cumulative time', 'Self time'],
+        [(name, '%.3fs' % cumulative, '%.3fs' % own)
+            for name, (cumulative, own) in imports])
+
+
+def load_durations(filename):
+    "Return the {module: seconds} stored in filename, empty if unknown"
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_durations(filename, durations):
+    "Update filename with the {module: seconds} of durations"
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    data = load_durations(filename)
+    data.update(durations)
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=4, sort_keys=True)
+    os.rename(tmp, filename)
+
+
+def split_modules(modules, jobs, durations):
+    """
+    Split modules in jobs lists with similar total durations, giving each
+    module, the slowest first, to the list with the lowest total so far.
+    Modules without duration count as the average of the known ones and
+    modules are split by count if no duration is known at all.
+    """
+    known = [durations[m] for m in modules if m in durations]
+    if not known:
+        return [modules[i::jobs] for i in range(jobs)]
+    average = sum(known) / len(known)
+    shards = [[] for i in range(jobs)]
+    loads = [(0.0, i) for i in range(jobs)]
+    for module in sorted(modules, key=lambda m: durations.get(m, average),
+            reverse=True):
+        load, i = heapq.heappop(loads)
+        shards[i].append(module)
+        heapq.heappush(loads, (load + durations.get(module, average), i))
+    return [s for s in shards if s]
+
+
+class ForkedProcess(object):
+    """
+    Run function(*args) with env in a child process forked from this one.
+    Only the wait() and returncode of Popen are implemented.
+    """
+
+    def __init__(self, function, args=(), env=None):
+        self.returncode = None
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid:
+            return
+        code = 0
+        try:
+            if env is not None:
+                os.environ.update(env)
+            function(*args)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def wait(self):
+        if self.returncode is None:
+            _, status = os.waitpid(self.pid, 0)
+            if os.WIFSIGNALED(status):
+                self.returncode = -os.WTERMSIG(status)
+            else:
+                self.returncode = os.WEXITSTATUS(status)
+        return self.returncode
+
+
+def run_shard(modules, output):
+    "Run the tests of modules and store their results in the output file"
+    suite = build_suite(modules)
+    with open(output, 'wb') as fp:
+        result = HTMLTestRunner._TestResult(failfast=options['failfast'],
+            listener=HTMLTestRunner.ResultDumper(fp),
+            output_limit=options['output_limit'], group=test_module,
+            on_start=on_start, on_stop=on_stop, profile_dir=profile_dir)
+        suite(result)
+    if profile_dir:
+        result.dumpProfiles()
+
+
+def run_shards(result, shards):
+    """
+    Run each list of modules of shards in its own process with its own
+    database and add their results to result, one shard after the other.
+    The databases of the processes are dropped once they finish.
+    The processes are forked from this one once trytond, proteus and the
+    packages of the modules are imported, except with coverage where each
+    one is a new test.py process measuring its own tests.
+    """
+    fork = not options['coverage']
+    if fork:
+        preimport()
+        for modules in shards:
+            import_modules(modules)
+    if profiler is not None:
+        profiler.uninstall()
+    database = database_name()
+    workdir = tempfile.mkdtemp(prefix='tryton-tests-')
+    processes = []
+    databases = []
+    try:
+        for i, modules in enumerate(shards):
+            output = os.path.join(workdir, 'shard-%d' % i)
+            env = os.environ.copy()
+            if CONFIG['db_type'] == 'sqlite' and options['no_template']:
+                env['DB_NAME'] = ':memory:'
+            else:
+                env['DB_NAME'] = '%s_%d' % (database, i)
+            databases.append(env['DB_NAME'])
+            if fork:
+                processes.append((ForkedProcess(run_shard, (modules, output),
+                            env), output))
+                continue
+            args = [sys.executable, __file__, '--shard', ','.join(modules),
+                '--shard-output', output]
+            if options['configfile']:
+                args += ['--config', options['configfile']]
+            if options['nereid']:
+                args += ['--nereid', options['nereid']]
+            if options['name']:
+                args += ['--name', options['name']]
+            if options['failfast']:
+                args.append('--failfast')
+            if options['no_template']:
+                args.append('--no-template')
+            if options['fast_sqlite']:
+                args.append('--fast-sqlite')
+            if options['coverage']:
+                args.append('--coverage')
+            if options['impact_map']:
+                args += ['--impact-map', options['impact_map']]
+            if options['changed_files']:
+                args += ['--changed-files', options['changed_files']]
+            if options['profile']:
+                args += ['--profile', '--output', path]
+            args += ['--output-limit', str(options['output_limit'])]
+            processes.append((subprocess.Popen(args, env=env), output))
+
+        for i, (process, output) in enumerate(processes):
+            process.wait()
+            if os.path.exists(output):
+                with open(output, 'rb') as fp:
+                    result.load(fp)
+            if process.returncode:
+                result.testsRun += 1
+                result.error_count += 1
+                result.addRecord((2, HTMLTestRunner.TestInfo(
+                            ShardError('runTest'), test_module), '',
+                        'Worker for modules %s exited with code %s'
+                        % (', '.join(shards[i]), process.returncode)))
+    finally:
+        for process, _ in processes:
+            process.wait()
+        for name in databases:
+            try:
+                drop_database(name)
+            except Exception:
+                traceback.print_exc()
+        shutil.rmtree(workdir)
+
+
+# trytond modules which can be imported once for all the test runs, the
+# packages of the modules are not as watch() imports them again on each run
+PREIMPORT = [
+    'trytond.backend',
+    'trytond.model',
+    'trytond.modules',
+    'trytond.pool',
+    'trytond.report',
+    'trytond.transaction',
+    'trytond.wizard',
+    'proteus',
+    ]
+
+
+def preimport():
+    "Import PREIMPORT, the ones missing on this version are skipped"
+    for name in PREIMPORT:
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+
+
+def import_modules(modules):
+    """
+    Import the packages of modules, which do not depend on the database of
+    the test run unlike their tests
+    """
+    for module in modules:
+        if module in ('trytond', 'proteus'):
+            continue
+        try:
+            __import__('trytond.modules.%s' % module)
+        except ImportError:
+            pass
+
+
+def file_mtimes(paths):
+    "Return the {filename: mtime} of the files found in paths"
+    result = {}
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for name in files:
+                if name.startswith('.') or name.endswith(('.pyc', '.pyo')):
+                    continue
+                filename = os.path.join(root, name)
+                try:
+                    result[filename] = os.stat(filename).st_mtime
+                except OSError:
+                    pass
+    return result
+
+
+def run_child(modules):
+    """
+    Run the tests of modules in a child process forked from this one, with
+    its own database, wait for it and drop the database.
+    """
+    database = database_name()
+    ForkedProcess(run_tests, (modules,), {'DB_NAME': database}).wait()
+    try:
+        drop_database(database)
+    except Exception:
+        traceback.print_exc()
+
+
+def watch(interval=1):
+    """
+    Run the tests and then, each time a file changes, the tests of the
+    modules changed and of the ones depending on them. Each run is a child
+    process forked from this one, which keeps trytond imported, so the
+    modules are imported again. The process is restarted when a file outside
+    of the modules changes as it can not be imported again.
+    """
+    preimport()
+    paths = [trytond_root(), os.path.abspath('proteus')]
+    roots = modulegraph.module_roots(paths[0])
+    graph = modulegraph.module_dependencies(roots)
+    mtimes = file_mtimes(paths)
+    run_child(options['modules'])
+    while True:
+        time.sleep(interval)
+        current = file_mtimes(paths)
+        changed = [f for f in set(mtimes) | set(current)
+            if mtimes.get(f) != current.get(f)]
+        if not changed:
+            continue
+        mtimes = current
+        modules = set()
+        for filename in changed:
+            _, module = modulegraph.get_module(roots, filename)
+            if module is None:
+                print >>sys.stderr, '%s changed, restarting' % filename
+                os.execv(sys.executable, [sys.executable] + sys.argv)
+            modules.add(module)
+        modules = modulegraph.test_groups(
+            modulegraph.dependents(graph, modules))
+        if options['modules'] is not None:
+            modules &= options['modules']
+        if modules:
+            print >>sys.stderr, 'Testing %s' % ', '.join(sorted(modules))
+            run_child(modules)
+
+
+class ShardError(unittest.TestCase):
+    "A --jobs worker process did not finish properly"
+
+    def runTest(self):
+        pass
+
 
 basename = ''
 if options['name']:
@@ -73,22 +881,95 @@ if options.get('output'):
 else:
     path = '/home/%s/public_html' % getpass.getuser()
 filename = '%s/%s.html' % (path, basename)
+durations_filename = (options['durations']
+    or os.path.expanduser('~/.tryton-tests-cache/%s-durations.json'
+        % basename))
 title = 'Tryton unittest %s' % CONFIG['db_type']
+profile_dir = None
+if options['profile']:
+    profile_dir = '%s/%s-profile' % (path, basename)
+
+on_start = on_stop = None
+if options['coverage'] and options['impact_map']:
+    if hasattr(cov, 'switch_context'):
+        # Record the lines run by each test under its module and id, the
+        # ones run between the tests under the empty context
+        on_start = lambda test: cov.switch_context('%s %s'
+            % (test_module(test), test.id()))
+        on_stop = lambda test: cov.switch_context('')
+    else:
+        print >>sys.stderr, 'coverage 5 is needed to record --impact-map'
+        options['impact_map'] = None
+
+if CONFIG['db_type'] == 'sqlite' and options['fast_sqlite']:
+    use_fast_sqlite()
+
+if options['shard'] is not None:
+    run_shard(options['shard'].split(','), options['shard_output'])
+    if options['coverage']:
+        cov.stop()
+        cov.save()
+    sys.exit(0)
+
+
+def run_tests(modules=None):
+    "Run the tests of modules, or all of them, and write their reports"
+    if profile_dir:
+        if os.path.exists(profile_dir):
+            shutil.rmtree(profile_dir)
+        os.makedirs(profile_dir)
+    fp = file(filename, 'wb')
+    json_fp = file('%s/%s.jsonl' % (path, basename), 'wb')
+    junit_fp = file('%s/%s.xml' % (path, basename), 'wb')
+    runner = HTMLTestRunner.HTMLTestRunner(
+            stream=fp,
+            title=title,
+            failfast=options.get('failfast', False),
+            output_limit=options['output_limit'],
+            json_stream=json_fp,
+            junit_stream=junit_fp,
+            group=test_module,
+            on_start=on_start,
+            on_stop=on_stop,
+            profile_dir=profile_dir,
+            )
+
+    if options['jobs'] > 1:
+        from trytond.modules import get_module_list
+        names = ['trytond'] + sorted(set(get_module_list())) + ['proteus']
+        if modules is not None:
+            names = [m for m in names if m in modules]
+        jobs = max(min(options['jobs'], len(names)), 1)
+        result = HTMLTestRunner._TestResult(failfast=options['failfast'],
+            listener=runner)
+        runner.startReport()
+        run_shards(result, split_modules(names, jobs,
+                load_durations(durations_filename)))
+        add_startup_sections(runner)
+        runner.stopReport(result)
+    else:
+        try:
+            suite = build_suite(modules)
+            add_startup_sections(runner)
+            runner.run(suite)
+        finally:
+            drop_test_database()
+    for f in (fp, json_fp, junit_fp):
+        f.close()
+    save_durations(durations_filename, runner.groupTimes)
 
-fp = file(filename, 'wb')
-runner = HTMLTestRunner.HTMLTestRunner(
-        stream=fp,
-        title=title,
-        failfast=options.get('failfast', False)
-        )
-suite = test_tryton.modules_suite()
-suite.addTests(proteus.tests.test_suite())
 
-runner.run(suite)
+if options['watch']:
+    watch()
+run_tests(options['modules'])
 
 if options['coverage']:
     cov.stop()
+    if options['jobs'] > 1:
+        cov.combine()
     cov.save()
+    if options['impact_map']:
+        save_impact_map(options['impact_map'], cov)
     if options.get('coverage_dir'):
         coverage_dir = options['coverage_dir']
         if not coverage_dir.startswith('/'):